@@ -48,40 +48,37 @@ expenses = {
     "SPMFICA" : "SPM unit's FICA and federal retirement"
 }
 
-def load_and_preprocess_asec_data(filepath_data, filepath_dictionary, fields="All"):
+# Numeric variables, which get converted to int/float as the data is loaded (all other variables are loaded as strings)
+int_vars = ["AGE", "UHRSWORKT", "UHRSWORKLY", "WKSWORK1", "PTWEEKS", # work variables
+    "LINENO", "ASPOUSE", "PECOHAB", "PELNMOM", "PELNDAD",   # family structure variables
+    "SPMNADULTS", "SPMNCHILD", "SPMNPERS", 
+    "INCTOT", "INCWAGE", "INCBUS", "INCFARM", "INCSS", "INCWELFR", "INCRETIR", "INCSSI", # income variables
+    "INCINT", "INCUNEMP", "INCWKCOM", "INCVET", "INCSURV", "INCDISAB", "INCDIVID", 
+    "INCRENT", "INCEDUC", "INCCHILD", "INCASIST", "INCOTHER"]
+float_vars = ["SPMTOTRES", "SPMTHRESH",
+    "SPMLUNCH", "SPMCAPHOUS", "SPMWIC", "SPMHEAT", "SPMSNAP", "SPMEITC", # shared family benefits and expenses
+    "SPMMEDXPNS", "SPMCAPXPNS", "SPMWKXPNS", "SPMCHXPNS", "SPMCHSUP", "SPMSTTAX", "SPMFEDTAXAC", "SPMFEDTAXBC","SPMFICA",
+    "EITCRED", "STATAXAC", "FEDTAXAC", "FICA", "WKXPNS",
+    "ASECWTH", "ASECWT"] + ["REPWT"+str(i+1) for i in range(160)] + ["REPWTP"+str(i+1) for i in range(160)] # weights (including replicate weights)
+field_types = {**{var: "int" for var in int_vars}, **{var: "float" for var in float_vars}}
+
+def load_and_preprocess_asec_data(filepath_data, filepath_dictionary, fields="All", cache_dir=None):
     # Load the data and data dictionary
+    # The int and float variables are converted while the data is being loaded (see field_types above).
+    # If a cache_dir is given, the raw data gets cached there after the first load (see load_csv_columns); 
+    # since the analyses below work on rows, this saves little time (see load_csv_data).
     global data_dictionary_compact
     data_dictionary_compact = load_JSON(filepath_dictionary)
-    data = load_csv_data(filepath_data, fields=fields) # 185,487
-
-    # Preprocess the data
+    set_field_types(data_dictionary_compact, field_types)
     # Filter out people who weren't in the rotation to be give a CPS interview ("ASEC oversampling")
-    # and thus cannot be connected to longitudinal CPS data / timeuse data
+    # and thus cannot be connected to longitudinal CPS data / timeuse data.
+    # The filter is applied while loading, so these persons never get loaded in the first place.
     log("Filtering out persons without a CPS ID, whose records cannot be connected to longitudinal data..")
-    data = [p for p in data if p["CPSIDP"]!="0"] # 117,990 
-    
-    # Convert int and float variables
-    log("Converting int and float variables.. ")
-    int_vars = ["AGE", "UHRSWORKT", "UHRSWORKLY", "WKSWORK1", "PTWEEKS", # work variables
-        "LINENO", "ASPOUSE", "PECOHAB", "PELNMOM", "PELNDAD",   # family structure variables
-        "SPMNADULTS", "SPMNCHILD", "SPMNPERS", 
-        "INCTOT", "INCWAGE", "INCBUS", "INCFARM", "INCSS", "INCWELFR", "INCRETIR", "INCSSI", # income variables
-        "INCINT", "INCUNEMP", "INCWKCOM", "INCVET", "INCSURV", "INCDISAB", "INCDIVID", 
-        "INCRENT", "INCEDUC", "INCCHILD", "INCASIST", "INCOTHER"]
-    float_vars = ["SPMTOTRES", "SPMTHRESH",
-        "SPMLUNCH", "SPMCAPHOUS", "SPMWIC", "SPMHEAT", "SPMSNAP", "SPMEITC", # shared family benefits and expenses
-        "SPMMEDXPNS", "SPMCAPXPNS", "SPMWKXPNS", "SPMCHXPNS", "SPMCHSUP", "SPMSTTAX", "SPMFEDTAXAC", "SPMFEDTAXBC","SPMFICA",
-        "EITCRED", "STATAXAC", "FEDTAXAC", "FICA", "WKXPNS",
-        "ASECWTH", "ASECWT"] + ["REPWT"+str(i+1) for i in range(160)] + ["REPWTP"+str(i+1) for i in range(160)] # weights (including replicate weights)
-    for int_var in int_vars:
-        if int_var in data[0]: # If one of the variables we read
-            for p in data:
-                p[int_var] = int(p[int_var])
-    for float_var in float_vars:
-        if float_var in data[0]: # If one of the variables we read
-            for p in data:
-                p[float_var] = float(p[float_var])
-   
+    filters = {"CPSIDP": lambda cpsidp: cpsidp != "0"}
+    data = load_csv_data(filepath_data, fields=fields, cache_dir=cache_dir, data_dictionary=data_dictionary_compact, 
+        filters=filters) # 117,990 (out of 185,487)
+
+    # Preprocess the data
     # Normalize person weights so that across the entire dataset they sum to the US population
     us_population = 323.4*(10**6)
     ndata = weighted_len(data, "ASECWT") # total # of persons the ASEC dataset represents
@@ -116,26 +113,22 @@ def correct_fed_tax(data):
         p["SPMFEDTAXBC_2"] = float(p["SPMFEDTAXAC"]) + float(p["SPMEITC"])
 
 def explore_variable_work_schedule(data):    
-    employed = [p for p in data if p["UHRSWORKT"]!=999] # 55,575
-    hours_vary = [p for p in data if p["UHRSWORKT"]==997] # 3,879
+    # Weighted statistics below are computed for the main weight and all replicate weights at once (see ReplicateWeights)
+    rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    uhrsworkt = column(data, "UHRSWORKT")
+    spm_perc = column(data, "spm_perc")
+    employed = uhrsworkt != 999 # 55,575
+    hours_vary = uhrsworkt == 997 # 3,879
     
     # Calculate % of all employees who report working variable hours
-    perc = weighted_len(hours_vary, "ASECWT")/weighted_len(employed, "ASECWT")*100
+    perc = rw.ratio(hours_vary, employed)[0]*100
     log("%" + "{:.1f}".format(perc) + " report working irregular # hours / week.")
 
     # Calculate % of employees who report working variable hours by poverty level
-    perc_hours_vary = []
-    se = []
     wbin = 100
     bins = list(range(0, 701, wbin))
-    for bin_left in bins[:-1]:
-        bin_right = bin_left + wbin
-        employed_bin = [p for p in employed if p["spm_perc"] >= bin_left and p["spm_perc"] < bin_right]
-        hours_vary_bin = [p for p in hours_vary if p["spm_perc"] >= bin_left and p["spm_perc"] < bin_right]        
-        f = lambda wf: weighted_len(hours_vary_bin, wf)/weighted_len(employed_bin, wf)*100
-        perc_bin, se_bin = compute_estimate_and_standard_error(f, "ASECWT", "REPWTP")
-        perc_hours_vary.append(perc_bin)
-        se.append(se_bin)
+    perc_hours_vary, se = WeightedBins(rw, spm_perc, bins).ratio(hours_vary, employed)
+    perc_hours_vary, se = perc_hours_vary*100, se*100
 
     # Visualize
     mid_bins = [x + wbin/2 for x in bins[:-1]]
@@ -154,12 +147,11 @@ def explore_variable_work_schedule(data):
     # Calculate % of employees who report working variable hours by poverty level
     perc_hours_vary = []
     se = []
+    occ = column(data, "OCC")
     for industry in industries:
-        occ_codes = occ_hierarchical[industry].keys()
-        employed_industry = [p for p in employed if p["OCC"] in occ_codes]
-        hours_vary_industry = [p for p in hours_vary if p["OCC"] in occ_codes]
-        f = lambda wf: weighted_len(hours_vary_industry, wf)/weighted_len(employed_industry, wf)*100
-        perc_bin, se_bin = compute_estimate_and_standard_error(f, "ASECWT", "REPWTP")
+        occ_codes = list(occ_hierarchical[industry].keys())
+        in_industry = np.isin(occ, occ_codes)
+        perc_bin, se_bin = get_estimate_and_standard_error(rw.ratio(hours_vary & in_industry, employed & in_industry)*100)
         perc_hours_vary.append(perc_bin)
         se.append(se_bin)
 
@@ -265,10 +257,13 @@ def explore_poverty_demographics(data):
     print(f'People in poverty who worked the entire year full time, brought home a median of ${weighted_median(allyear_fulltime, "INCTOT", "ASECWT") :,.0f}.')
 
     # What industries were they in?
-    jobs = weighted_counter(poor_employed, "INDLY", "ASECWT")
+    # (computed with WeightedGroupBy over the full dataset, to also get standard errors)
+    rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    is_poor_employed = (column(data, "spm_perc") <= 100) & (column(data, "WORKLY") == "2")
+    jobs = WeightedGroupBy(rw, [column(data, "INDLY")], mask = is_poor_employed).counter()
     for job in jobs:
         job["adj_count"] = adj * job["count"]
-        print(f'{job["key"]}: ({job["perc"] :.1f}% = {job["adj_count"] :,.0f} persons)')
+        print(f'{job["key"]}: ({job["perc"] :.1f}% ± {job["perc_se"] :.1f}% = {job["adj_count"] :,.0f} persons)')
 
     fig, ax = plt.subplots()
     nbars = len(jobs)
@@ -277,39 +272,38 @@ def explore_poverty_demographics(data):
     ax.set_yticklabels([x["key"] for x in jobs])
     ax.invert_yaxis()
 
-def explore_housing_family_doubling_up(data):
+def explore_housing_family_doubling_up(data, nworkers=1):
     log("Exploring the phenomenon of families doubling up.. ")
 
     # Bundle persons into households, and annotate the households with family subunits
     # A family subunit consists of a person + their spouse/unmarried partner (if any) + DEPENDENT children (if any)
     # Dependent children are defined as <21 years old who do NOT have their own family sub-unit
     # (spouse/unmarried partner or own children).
-    households = bundle_persons_into_households(data)
-    annotate_households_with_family_subunits(households)
-
     # Households with more than one family subunit are doubling up
     # E.g. A nuclear family + the householder's elderly parent.
-    doubling_up = [hh for hh in households if hh["n_subunits"] > 1] # 7,502 households 
+    # For those, also split the shared resources between subunits and recompute their poverty levels
+    # (see process_doubling_up_households; with nworkers > 1 the households are processed in parallel).
+    # Household weights and poverty levels are read directly from the householders, over the columnar 
+    # household layout (households are bundled in the same order, see bundle_persons_into_households).
+    household_weight_fields = ["ASECWTH"] + ["REPWT"+str(i+1) for i in range(160)]
+    hhc = HouseholdColumns(data, household_weight_fields + ["spm_perc"])
+    households = bundle_persons_into_households(data, hhc)
+    households, doubling_up, n_ambiguous = process_doubling_up_households(households, nworkers) # 7,502 households doubling up
+    rw = ReplicateWeights({field: hhc.first(field) for field in household_weight_fields}, "ASECWTH", "REPWT")
+    is_doubling_up = column(households, "n_subunits") > 1
 
     # Compute what % of all households are doubling up
-    n_doubling_up = weighted_len(doubling_up, "ASECWTH")
-    n_households = weighted_len(households, "ASECWTH")
+    n_doubling_up = rw.total(is_doubling_up)[0]
+    n_households = rw.total()[0]
     perc_doubling_up = n_doubling_up / n_households * 100
     print(f"{perc_doubling_up :.2f}% households are doubling up.") # 15.09%
 
     # Visualize % of households doubling up by poverty level
     wbin = 100
     bins = list(range(0, 1001, wbin))
-    perc_doubling_up_bin = []
-    se = []
-    for bin_left in bins[:-1]:
-        bin_right = bin_left + wbin
-        all_households_bin = [hh for hh in households if hh["spm_perc"] >= bin_left and hh["spm_perc"] < bin_right]
-        doubling_up_bin = [hh for hh in doubling_up if hh["spm_perc"] >= bin_left and hh["spm_perc"] < bin_right]        
-        f = lambda wf: weighted_len(doubling_up_bin, wf)/weighted_len(all_households_bin, wf)*100
-        perc_bin, se_bin = compute_estimate_and_standard_error(f, "ASECWTH", "REPWT")
-        perc_doubling_up_bin.append(perc_bin)
-        se.append(se_bin)
+    poverty_bins = WeightedBins(rw, hhc.first("spm_perc"), bins)
+    perc_doubling_up_bin, se = poverty_bins.ratio(is_doubling_up, None)
+    perc_doubling_up_bin, se = perc_doubling_up_bin*100, se*100
 
     mid_bins = [x + wbin/2 for x in bins[:-1]]
     fig, ax = plt.subplots()
@@ -319,24 +313,96 @@ def explore_housing_family_doubling_up(data):
     ax.set_title('Percentage of households in which family members are "doubling up", by poverty level')
     # TODO: Switch to fractions (3x poverty line) instead of %s (300% poverty line)
 
-    explore_financial_impact_doubling_up(doubling_up)
+    explore_financial_impact_doubling_up(doubling_up, n_ambiguous)
+
+def process_doubling_up_households(households, nworkers=1):
+    # Runs the per-household part of the doubling up analysis: annotate households with family subunits, 
+    # then for households that are doubling up, split shared resources between subunits and compute 
+    # resources/poverty levels excluding SNAP and medical expenses. 
+    # Households are independent of each other, so with nworkers > 1 they are split into shards which are 
+    # processed by a pool of forked worker processes. The workers inherit the households (copy-on-write, 
+    # through the module global doubling_up_households) and only get the index range of their shard, and 
+    # only send back the results for each household (see process_doubling_up_task), which get applied to 
+    # the households in order, so the households end up exactly as if processed serially. 
+    # Falls back to processing the households serially where fork isn't available (e.g. Windows).
+    # Returns (households, households doubling up, # households doubling up marked as ambiguous).
+    global doubling_up_households
+    if nworkers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return process_doubling_up_shard(households)
+    nshards = 4 * nworkers
+    shard_size = ceil(len(households) / nshards)
+    shards = [(i, min(i+shard_size, len(households))) for i in range(0, len(households), shard_size)]
+    log(f"Processing {len(households)} households in {len(shards)} shards with {nworkers} workers..")
+    n_ambiguous = 0
+    doubling_up_households = households
+    try:
+        with multiprocessing.get_context("fork").Pool(nworkers) as pool:
+            for ((start, end), (results, shard_n_ambiguous)) in zip(shards, pool.imap(process_doubling_up_task, shards)):
+                for (hh, result) in zip(households[start:end], results):
+                    apply_doubling_up_result(hh, result)
+                n_ambiguous += shard_n_ambiguous
+    finally:
+        doubling_up_households = None
+    doubling_up = [hh for hh in households if hh["n_subunits"] > 1]
+    return households, doubling_up, n_ambiguous
+
+def process_doubling_up_shard(households):
+    annotate_households_with_family_subunits(households)
+    doubling_up = [hh for hh in households if hh["n_subunits"] > 1]
+    n_ambiguous = split_shared_resources_between_family_subunits(doubling_up)
+    compute_partial_resources([hh for hh in doubling_up if sum(hh["ambiguous"].values())==0])
+    return households, doubling_up, n_ambiguous
+
+doubling_up_households = None # The households being processed by process_doubling_up_households, inherited by the workers
+
+# Household fields set by process_doubling_up_shard (in addition to hh["n_subunits"] and the subunits)
+doubling_up_result_fields = ["ambiguous", "SPMTOTRES_partial", "spm_perc_partial"]
+
+def process_doubling_up_task(shard):
+    # Runs in a worker: process the households in the shard (the worker's own copy of them), and return 
+    # just what process_doubling_up_shard added to each household: subunit of each person in the SPM unit, 
+    # n_subunits, and for households doubling up, the subunit resources (without the persons) and the result fields.
+    start, end = shard
+    households, _, n_ambiguous = process_doubling_up_shard(doubling_up_households[start:end])
+    results = []
+    for hh in households:
+        result = {
+            "person_subunits": [p["subunit"] for p in hh["persons_spm"]], 
+            "n_subunits": hh["n_subunits"]
+        }
+        if "subunits" in hh:
+            result["subunits"] = [{field: value for (field, value) in subunit.items() if field != "persons_spm"} 
+                for subunit in hh["subunits"]]
+        result.update({field: hh[field] for field in doubling_up_result_fields if field in hh})
+        results.append(result)
+    return results, n_ambiguous
+
+def apply_doubling_up_result(hh, result):
+    for (p, subunit) in zip(hh["persons_spm"], result["person_subunits"]):
+        p["subunit"] = subunit
+    hh["n_subunits"] = result["n_subunits"]
+    if "subunits" in result:
+        hh["subunits"] = []
+        for (i, subunit) in enumerate(result["subunits"]):
+            hh["subunits"].append({"persons_spm": [p for p in hh["persons_spm"] if p["subunit"] == i+1], **subunit})
+    for field in doubling_up_result_fields:
+        if field in result:
+            hh[field] = result[field]
 
-def bundle_persons_into_households(data):
+def bundle_persons_into_households(data, hhc=None):
     log("Bunding persons into households..")
-    # Bundle persons into households
-    cpsids = list(set([p["CPSID"] for p in data]))
-    households = {cpsid: {"persons": []} for cpsid in cpsids}
-    for p in data:
-        households[p["CPSID"]]["persons"].append(p)
-    # Convert to list so I can compute weighted statistics over it
-    households = list(households.values())
+    # Bundle persons into households, in the same order as the columnar household layout hhc 
+    # (households sorted by CPSID, persons in their original order), so household i of both line up.
+    if hhc is None:
+        hhc = HouseholdColumns(data, [])
+    households = [{"persons": [data[i] for i in hhc.order[start:end]]} for (start, end) in zip(hhc.offsets[:-1], hhc.offsets[1:])]
     # Annotate households with relevant info (currently stored at person level)
+    # (household weights aren't copied: read them from the householders with hhc.first instead)
     log("Annotating households with relevant info currently stored at person level..")
     relevant_fields = ["CPSID", "SPMFAMUNIT", # IDs
-        "SPMTOTRES", "SPMTHRESH", "spm_perc", "SPMNADULTS", "SPMNCHILD", "SPMNPERS", # poverty info
+        "SPMTOTRES", "SPMTHRESH", "SPMNADULTS", "SPMNCHILD", "SPMNPERS", # poverty info
         "SPMLUNCH", "SPMCAPHOUS", "SPMWIC", "SPMHEAT", "SPMSNAP", "SPMEITC", # shared household benefits
-        "SPMMEDXPNS", "SPMCAPXPNS", "SPMWKXPNS", "SPMCHXPNS", "SPMCHSUP", "SPMSTTAX", "SPMFEDTAXAC", "SPMFEDTAXBC_2", "SPMFICA", # shared household expenses
-        "ASECWTH"] + ["REPWT"+str(i+1) for i in range(160)] # household weights (including replicate weights)
+        "SPMMEDXPNS", "SPMCAPXPNS", "SPMWKXPNS", "SPMCHXPNS", "SPMCHSUP", "SPMSTTAX", "SPMFEDTAXAC", "SPMFEDTAXBC_2", "SPMFICA"] # shared household expenses
     for hh in households:
         # Copy over relevant fields from householder to entire household
         p0 = hh["persons"][0] # householder
@@ -347,6 +413,62 @@ def bundle_persons_into_households(data):
     log("Bunding persons into households completed.")
     return households
 
+class HouseholdColumns:
+    # Columnar (CSR-style) layout of persons grouped into households: person fields are stored as columns, 
+    # (stable) sorted by household, and offsets[i]:offsets[i+1] is the row range of household i. 
+    # Household-level values are computed with segment reductions over these ranges instead of 
+    # building per-household dicts, and household fields are read from the first person in the household 
+    # (the householder, as in bundle_persons_into_households) rather than copied to every household.
+
+    ### Example use:
+    # hhc = HouseholdColumns(data, ["AGE", "SPMFAMUNIT", "ASECWTH"])
+    # nchildren = hhc.count(hhc["AGE"] < 18) # number of children in each household
+    # has_senior = hhc.any(hhc["AGE"] >= 65)
+    # weights = hhc.first("ASECWTH")
+
+    def __init__(self, data, fields, household_field = "CPSID"):
+        keys = column(data, household_field)
+        self.order = np.argsort(keys, kind="stable") # row of each person in data
+        keys = keys[self.order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if len(keys) > 0 else np.zeros(0, dtype=np.intp)
+        self.offsets = np.append(starts, len(keys))
+        self.household_ids = keys[starts]
+        self.columns = {field: column(data, field)[self.order] for field in fields}
+
+    def __len__(self):
+        return len(self.household_ids)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def first(self, field):
+        # Value of a field for the first person (householder) of each household
+        return self.columns[field][self.offsets[:-1]]
+
+    def sum(self, values):
+        # Sum of per-person values over each household
+        values = np.asarray(values)
+        if len(self) == 0:
+            return values[:0]
+        return np.add.reduceat(values, self.offsets[:-1])
+
+    def count(self, mask):
+        # Number of persons in each household for which mask is True
+        return self.sum(np.asarray(mask, dtype=np.int64))
+
+    def any(self, mask):
+        return self.count(mask) > 0
+
+    def all(self, mask):
+        return self.count(mask) == self.sizes()
+
+    def broadcast(self, household_values):
+        # Expand per-household values to each of the persons in the household (e.g. to compare with person fields)
+        return np.repeat(household_values, self.sizes())
+
 def annotate_households_with_family_subunits(households):
     # Split SPM family units into family sub-units consisting only of:
     # a person + their spouse/unmarried partner (if any) + DEPENDENT children (if any)
@@ -358,19 +480,20 @@ def annotate_households_with_family_subunits(households):
     for hh in households:
         p_spm = hh["persons_spm"] # persons in the SPM unit
         p_spm = sorted(p_spm, key=lambda p: p["AGE"], reverse=True) # sort decreasing by age
+        relationships = HouseholdRelationships(hh["persons"]) # index the family relationships once per household
         for p in p_spm: # to begin with, nobody is assigned to any subunit
             p["subunit"] = -1
         n_subunits = 0
         for p in p_spm: # for each person in the SPM unit (in decreasing age order)
-            if is_independent_adult(p, hh): # independent adult
-                partner = get_partner(p, hh)
+            if is_independent_adult(p, hh, relationships): # independent adult
+                partner = get_partner(p, hh, relationships)
                 if(partner != None) and (partner["subunit"] != -1):
                     p["subunit"] = partner["subunit"] # same subunit as partner
                 else: # new subunit!
                     n_subunits += 1
                     p["subunit"] = n_subunits
             else: # children
-                parents = get_parents(p, hh)
+                parents = get_parents(p, hh, relationships)
                 if len(parents) > 0:
                     p["subunit"] = parents[0]["subunit"] # same subunit as parent
         # Anybody at this point with subunit -1 are "dependents" who haven't been allocated to a subunit yet
@@ -481,12 +604,51 @@ def split_shared_resources_between_family_subunits(doubling_up):
                 total_resource = sum([subunit[resource] for subunit in hh["subunits"]])
                 assert(abs(total_resource - hh[resource])<10)
 
-    # Check how many households I marked as "ambiguous"
+    # Return how many households I marked as "ambiguous"
     n_ambiguous = len([hh for hh in doubling_up if sum(hh["ambiguous"].values())>0])
-    perc_ambiguous = n_ambiguous / len(doubling_up) * 100
-    print(f"{perc_ambiguous :.1f}% households marked as ambiguous ({n_ambiguous} out of {len(doubling_up)})") # 4.8% (360 out of 7502)
+    return n_ambiguous
 
-def explore_financial_impact_doubling_up(doubling_up):
+def compute_partial_resources(households):
+    # Calculate resources and poverty level EXCLUDING a) SNAP benefits and b) medical expenses, 
+    # for a list of households doubling up
+    # Run calculations for entire SPM unit...
+    for hh in households:
+        hh["SPMTOTRES_partial"] = hh["SPMTOTRES"] - (hh["SPMSNAP"] - hh["SPMMEDXPNS"]) # Exclude SNAP benefits and medical expenses
+        hh["spm_perc_partial"] = hh["SPMTOTRES_partial"] / hh["SPMTHRESH"] * 100
+    if len(households) == 0:
+        return
+    # ... as well as each individual subunit 
+    # Subunit incomes and sizes are summed over the persons of all the households at once, 
+    # grouped by (household, subunit) code = household # * nsubunits + subunit (subunits are numbered from 1)
+    persons = [p for hh in households for p in hh["persons_spm"]]
+    nsubunits = max(hh["n_subunits"] for hh in households) + 1
+    ncodes = len(households) * nsubunits
+    codes = np.repeat(np.arange(len(households)), [len(hh["persons_spm"]) for hh in households]) * nsubunits + column(persons, "subunit", np.int64)
+    subunit_incomes = np.bincount(codes, weights=get_person_incomes(persons), minlength=ncodes) # incomes of each person 15+ yo
+    is_adult = (column(persons, "AGE", np.int64) >= 18) | np.isin(column(persons, "RELATE"), ["101", "201"])
+    subunit_nadults = np.bincount(codes, weights=is_adult, minlength=ncodes)
+    subunit_npersons = np.bincount(codes, minlength=ncodes)
+    subunit_incomes, subunit_nadults, subunit_npersons = subunit_incomes.tolist(), subunit_nadults.tolist(), subunit_npersons.tolist()
+    # Add benefits (except SNAP) and substract expenses (except medical), for all the subunits at once
+    subunits = [subunit for hh in households for subunit in hh["subunits"]]
+    partial_fields = [benefit for benefit in in_kind_benefits if benefit != "SPMSNAP"] + [expense for expense in expenses if expense != "SPMMEDXPNS"]
+    signs = np.array([1 if field in in_kind_benefits else -1 for field in partial_fields])
+    subunit_benefits = (column_block(subunits, partial_fields) @ signs).tolist()
+    n = 0 # Position of the subunit in subunits
+    for (h, hh) in enumerate(households):
+        family_scaling = SPM_family_scaling(hh["SPMNADULTS"], hh["SPMNCHILD"])
+        for (i, subunit) in enumerate(hh["subunits"]):
+            code = h * nsubunits + i + 1
+            subunit["SPMTOTRES_partial"] = int(subunit_incomes[code]) + subunit_benefits[n]
+            n += 1
+            # Also calculate the subunit threshhold
+            nadults = int(subunit_nadults[code])
+            nchild = subunit_npersons[code] - nadults
+            # Undo whole family scaling factor and multiply with subunit scaling factor
+            subunit["SPMTHRESH"] = hh["SPMTHRESH"] / family_scaling * SPM_family_scaling(nadults, nchild)
+            subunit["spm_perc_partial"] = subunit["SPMTOTRES_partial"] / subunit["SPMTHRESH"] * 100
+
+def explore_financial_impact_doubling_up(doubling_up, n_ambiguous):
     # Explore hypothesis that doubling up and sharing resources has a positive financial impact 
     # and helps get some families above the poverty line that would otherwise be in poverty.
     # The analysis is based on a rough estimate only due to the difficulty of splitting shared benefits/expenses
@@ -497,56 +659,31 @@ def explore_financial_impact_doubling_up(doubling_up):
     # into account in its calculations of poverty levels (departure from standard estimates), as well as discards
     # approximately 5% other households where the resources cannot be ambiguously allocated to subunits.
     
+    # The shared resources have already been split between family subunits, and resources and poverty levels
+    # calculated EXCLUDING a) SNAP benefits and b) medical expenses (see process_doubling_up_households)
     log("Exploring financial impact of doubling up..")
 
-    # Split shared resources between family subunits
-    split_shared_resources_between_family_subunits(doubling_up)
+    # Check how many households I marked as "ambiguous"
+    perc_ambiguous = n_ambiguous / len(doubling_up) * 100
+    print(f"{perc_ambiguous :.1f}% households marked as ambiguous ({n_ambiguous} out of {len(doubling_up)})") # 4.8% (360 out of 7502)
 
     # Filter out ambiguous cases (~5% of households)
     log("Filtering out ambiguous cases.. ")
     doubling_up = [hh for hh in doubling_up if sum(hh["ambiguous"].values())==0]
 
-    # Calculate resources and poverty level EXCLUDING a) SNAP benefits and b) medical expenses
-    log("Calculate resources and poverty level EXCLUDING a) SNAP benefits and b) medical expenses.. ")
-    for hh in doubling_up:
-        # Run calculations for entire SPM unit...
-        hh["SPMTOTRES_partial"] = hh["SPMTOTRES"] - (hh["SPMSNAP"] - hh["SPMMEDXPNS"]) # Exclude SNAP benefits and medical expenses
-        hh["spm_perc_partial"] = hh["SPMTOTRES_partial"] / hh["SPMTHRESH"] * 100
-        # ... as well as each individual subunit 
-        for subunit in hh["subunits"]:
-            subunit_resources_partial = 0
-            # Add incomes
-            for p in subunit["persons_spm"]:
-                if p["AGE"] >= 15:
-                    for income in income_sources:
-                        subunit_resources_partial += p[income]
-            # Add benefits (except SNAP)
-            for benefit in set(in_kind_benefits) - set(["SPMSNAP"]):
-                subunit_resources_partial += subunit[benefit]
-            # Substract expenses (except medical)
-            for expense in set(expenses) - set(["SPMMEDXPNS"]):
-                subunit_resources_partial -= subunit[expense]
-            subunit["SPMTOTRES_partial"] = subunit_resources_partial
-            # Also calculate the subunit threshhold
-            adults = [p for p in subunit["persons_spm"] if p["AGE"]>=18 or p["RELATE"] in ["101", "201"]]
-            nadults = len(adults)
-            nchild = len(subunit["persons_spm"]) - nadults
-            # Undo whole family scaling factor and multiply with subunit scaling factor
-            subunit["SPMTHRESH"] = hh["SPMTHRESH"] / SPM_family_scaling(hh["SPMNADULTS"], hh["SPMNCHILD"]) * SPM_family_scaling(nadults, nchild)
-            subunit["spm_perc_partial"] = subunit["SPMTOTRES_partial"] / subunit["SPMTHRESH"] * 100
-
     ### So what is the effect of doubling up on poverty?
+    hh_weighted_len = lambda hhs: weighted_len([hh["persons"][0] for hh in hhs], "ASECWTH") # household weights, from the householders
     # % households where at least one subunit is in poverty
     has_subunit_poverty = [hh for hh in doubling_up 
         if len([subunit for subunit in hh["subunits"] if subunit["spm_perc_partial"]<100])>0]
-    perc_has_subunit_poverty = weighted_len(has_subunit_poverty, "ASECWTH")/weighted_len(doubling_up, "ASECWTH")*100 # 58.7% of all households doubling up
+    perc_has_subunit_poverty = hh_weighted_len(has_subunit_poverty)/hh_weighted_len(doubling_up)*100 # 58.7% of all households doubling up
     log(f"{perc_has_subunit_poverty :.1f}% households that are doubling up have at least one subunit in poverty.. ") 
 
     # % households where doubling up has lifted at least one subunit out of poverty
     lifted_subunit_poverty = [hh for hh in doubling_up if 
         hh["spm_perc_partial"] >= 100 and # entire family above poverty
         len([subunit for subunit in hh["subunits"] if subunit["spm_perc_partial"]<100])>0]
-    perc_lifted_subunit_poverty = weighted_len(lifted_subunit_poverty, "ASECWTH")/weighted_len(has_subunit_poverty, "ASECWTH")*100 # 83.2% of those lifted the subunits out of poverty
+    perc_lifted_subunit_poverty = hh_weighted_len(lifted_subunit_poverty)/hh_weighted_len(has_subunit_poverty)*100 # 83.2% of those lifted the subunits out of poverty
     log(f"Of those, in {perc_lifted_subunit_poverty :.0f}% of cases doubling up has lifted the subunits out of poverty")
 
     # Number of people lifted out of poverty by doubling up
@@ -577,25 +714,56 @@ def explore_financial_impact_doubling_up(doubling_up):
 
 ### Family relationships
 
-def get_parents(p, hh):
-    parents = [p2 for p2 in hh["persons"] if p2["LINENO"] in [p["PELNMOM"], p["PELNDAD"]]]
+class HouseholdRelationships:
+    # Index of the family relationships within a household, built once per household 
+    # (in annotate_households_with_family_subunits) and passed to the helpers below, so that looking up a person's parents, partner or children doesn't require scanning the whole household:
+    #   - positions: LINENO -> positions of the person(s) with that LINENO in hh["persons"]
+    #   - children: LINENO -> persons whose mother or father (PELNMOM/PELNDAD) has that LINENO, in household order
+    def __init__(self, persons):
+        self.persons = persons
+        self.positions = {}
+        self.children = {}
+        for (i, p) in enumerate(persons):
+            self.positions.setdefault(p["LINENO"], []).append(i)
+        for p in persons:
+            for lineno in set([p["PELNMOM"], p["PELNDAD"]]):
+                self.children.setdefault(lineno, []).append(p)
+
+    def find(self, linenos):
+        # Persons with any of the given LINENOs, in household order
+        positions = sorted(set([i for lineno in linenos for i in self.positions.get(lineno, [])]))
+        return [self.persons[i] for i in positions]
+
+# The helpers below take an optional HouseholdRelationships index of hh; without it, they build one 
+# (which takes a pass over the household), so callers looking up several persons should build it once and pass it in.
+
+def get_parents(p, hh, relationships=None):
+    if relationships is None:
+        relationships = HouseholdRelationships(hh["persons"])
+    parents = relationships.find([p["PELNMOM"], p["PELNDAD"]])
     return parents
 
-def get_partner(p, hh):
-    partner = [p2 for p2 in hh["persons"] if p2["LINENO"] in [p["ASPOUSE"], p["PECOHAB"]]]
+def get_partner(p, hh, relationships=None):
+    if relationships is None:
+        relationships = HouseholdRelationships(hh["persons"])
+    partner = relationships.find([p["ASPOUSE"], p["PECOHAB"]])
     if len(partner)>0:
         return partner[0]
     else: 
         return None
 
-def get_children(p, hh):
-    children = [p2 for p2 in hh["persons"] if p["LINENO"] in [p2["PELNMOM"], p2["PELNDAD"]]]
+def get_children(p, hh, relationships=None):
+    if relationships is None:
+        relationships = HouseholdRelationships(hh["persons"])
+    children = list(relationships.children.get(p["LINENO"], []))
     return children
 
-def is_independent_adult(p, hh):
+def is_independent_adult(p, hh, relationships=None):
     # An independent adult is a person who is either 21+ years old OR has own primary family
     # (i.e. a spouse/cohabiting unmarried partner and/or children)
-    return (p["AGE"] >= 21) or (get_partner(p, hh) != None) or (len(get_children(p, hh))>0)
+    if relationships is None:
+        relationships = HouseholdRelationships(hh["persons"])
+    return (p["AGE"] >= 21) or (get_partner(p, hh, relationships) != None) or (len(get_children(p, hh, relationships))>0)
 
 ### SPM Units
 
@@ -610,68 +778,129 @@ def SPM_family_scaling(nadults, nchildren): # Family scaling factor
         scale = (nadults + 0.5*nchildren)**0.7
     return scale
 
-def sanity_check_spmthresholds(data, households):
-    ### Make sure I understand how SPMTHRESH is calculated:
+def validate_spmthresholds(data):
+    ### Check how SPMTHRESH is calculated:
     #      For each COUNTY and SPMMORT (tenure) there is a unique threshhold for a one-person SPM unit
     #      which then gets adjusted for family structure (scaling factor give by SPM_family_scaling)
+    # Persons are grouped by (COUNTY, SPMMORT) in a single pass (persons with unknown COUNTY "0" are skipped), 
+    # and the scaling factors are computed once per (SPMNADULTS, SPMNCHILD).
+    # Returns a report rather than asserting:
+    #   - thresholds: {county: {tenure: one-person threshold}}. If a group doesn't have a unique threshold, 
+    #       the most common one (by # persons) is used.
+    #   - non_unique: groups for which undoing the family scaling does NOT give a unique threshold
+    #   - mismatched: persons whose SPMTHRESH doesn't agree with the threshold derived for their group (off by >= $1)
+    scaling_factors = {}
+    def scaling(p):
+        family = (p["SPMNADULTS"], p["SPMNCHILD"])
+        if family not in scaling_factors:
+            scaling_factors[family] = SPM_family_scaling(*family)
+        return scaling_factors[family]
+
+    # Group persons by COUNTY and SPMMORT (tenure), collecting the thresholds once the family scaling is undone
+    groups = {}
+    for (i, p) in enumerate(data):
+        if p["COUNTY"] != "0":
+            group = groups.setdefault((p["COUNTY"], p["SPMMORT"]), {"persons": [], "threshs": Counter()})
+            group["persons"].append(i)
+            group["threshs"][round(p["SPMTHRESH"] / scaling(p), 2)] += 1
+
+    # Check that for each group there is a unique threshhold
+    thresholds = {}
+    non_unique = []
+    for ((county, tenure), group) in sorted(groups.items()):
+        thresholds.setdefault(county, {})[tenure] = group["threshs"].most_common(1)[0][0]
+        if len(group["threshs"]) > 1:
+            non_unique.append({"COUNTY": county, "SPMMORT": tenure, "npersons": len(group["persons"]), 
+                "thresholds": dict(group["threshs"].most_common())})
+
+    # Check that for all persons for which I know the COUNTY, my SPMTHRESH calculation agrees with the data
+    mismatched = []
+    for ((county, tenure), group) in groups.items():
+        for i in group["persons"]:
+            p = data[i]
+            my_thresh = thresholds[county][tenure] * scaling(p)
+            if not (abs(my_thresh - p["SPMTHRESH"])<1):
+                mismatched.append({"index": i, "COUNTY": county, "SPMMORT": tenure, 
+                    "SPMTHRESH": p["SPMTHRESH"], "expected": my_thresh})
+    mismatched = sorted(mismatched, key=lambda x: x["index"])
+
+    return {"thresholds": thresholds, "non_unique": non_unique, "mismatched": mismatched}
+
+def sanity_check_spmthresholds(data, households):
+    ### Make sure I understand how SPMTHRESH is calculated (see validate_spmthresholds)
     log("Sanity check that I understand how SPM thresholds are calculated..")
 
-    # Check that for each COUNTY and SPMMORT (tenure) there is a unique threshhold once I undo the family scaling
-    counties = sorted(list(set([p["COUNTY"] for p in data])))
-    tenures = sorted(list(set([p["SPMMORT"] for p in data])))
-    thresholds = {county:{tenure: None for tenure in tenures} for county in counties}
-    for county in counties[1:]: # For each county
-        for tenure in tenures: # For each tenure
-            persons = [p for p in data if p["COUNTY"] == county and p["SPMMORT"] == tenure]
-            # print(f"county: {county}, tenure: {tenure}, # persons: {len(persons)}")
-            if(len(persons) > 0):
-                threshs = [round(p["SPMTHRESH"] / SPM_family_scaling(p["SPMNADULTS"], p["SPMNCHILD"]), 2) for p in persons]
-                threshs = list(set(threshs))
-                assert(len(threshs) == 1) # If you reverse the family scaling factor, there is a unique threshhold
-                thresholds[county][tenure] = threshs[0]
-
-    # Sanity check that for all persons for which I know the COUNTY, my SPMTHRESH calculation agrees with the data
-    for i,p in enumerate(data):
-        if(p["COUNTY"] != "0"):
-            my_thresh = thresholds[p["COUNTY"]][p["SPMMORT"]] * SPM_family_scaling(p["SPMNADULTS"], p["SPMNCHILD"])
-            assert(abs(my_thresh - p["SPMTHRESH"])<1)
+    report = validate_spmthresholds(data)
+    log(f"{len(report['non_unique'])} (COUNTY, SPMMORT) groups without a unique threshold.")
+    for group in report["non_unique"]:
+        print(f"COUNTY: {group['COUNTY']}, SPMMORT: {group['SPMMORT']}, # persons: {group['npersons']}, thresholds (# persons): {group['thresholds']}")
+    log(f"{len(report['mismatched'])} persons with SPMTHRESH different from the calculated threshold.")
+    for p in report["mismatched"]:
+        print(f"Person #{p['index']} (COUNTY: {p['COUNTY']}, SPMMORT: {p['SPMMORT']}): SPMTHRESH {p['SPMTHRESH']}, calculated {p['expected'] :.2f}")
 
     # Sanity check that adults for the purpose of SPMNCHILD are defined as >=18yo OR the householder or their spouse
+    # (computed for all households at once over the columnar household layout)
     adult_age = 18
+    hhc = HouseholdColumns(data, ["SPMFAMUNIT", "AGE", "RELATE", "SPMNPERS", "SPMNADULTS", "SPMNCHILD"])
+    spmfam = hhc["SPMFAMUNIT"] == hhc.broadcast(hhc.first("SPMFAMUNIT")) # persons in the householder's SPM unit
+    npers = hhc.count(spmfam)
+    nadults = hhc.count(spmfam & ((hhc["AGE"] >= adult_age) | np.isin(hhc["RELATE"], ["101", "201"])))
+    nchild = npers - nadults
+    spmnpers, spmnadults, spmnchild = hhc.first("SPMNPERS"), hhc.first("SPMNADULTS"), hhc.first("SPMNCHILD")
+    consistent = (npers == spmnpers) & (spmnpers == spmnadults + spmnchild) & (nadults == spmnadults) & (nchild == spmnchild)
+    inconsistent = set(hhc.household_ids[~consistent].tolist())
     for i,hh in enumerate(households):
-        p0 = hh["persons"][0]
-        spmfam = [p for p in hh["persons"] if p["SPMFAMUNIT"] == p0["SPMFAMUNIT"]]
-        npers = len(spmfam)
-        adults = [p for p in spmfam if p["AGE"]>= adult_age or p["RELATE"] in ["101", "201"]]
-        nadults = len(adults)
-        nchild = npers - nadults
-        if not ((npers == p0["SPMNPERS"]) and (p0["SPMNPERS"] == p0["SPMNADULTS"] + p0["SPMNCHILD"]) and (nadults == p0["SPMNADULTS"]) and (nchild == p0["SPMNCHILD"])):
+        if hh["CPSID"] in inconsistent:
             print(i)
             print_household_profile(hh)
             print()
 
-def sanity_check_family_resources(data, households):
+def sanity_check_family_resources(data):
     log("Total family resource estimates that are off by >$10: ...")
-    for hh in households:
-        p0 = hh["persons"][0]
-        persons = [p for p in hh["persons"] if p["SPMFAMUNIT"] == p0["SPMFAMUNIT"]]
-        # Calculate total family resources
-        # Add incomes for persons 15+ yo
-        total_resources = 0
-        for p in persons:
-            if p["AGE"] >= 15:
-                for income in income_sources:
-                    total_resources += p[income]
-        # Add family-wide benefits
-        for benefit in in_kind_benefits:
-            total_resources += p0[benefit]
-        # Substract family-wide expenses
-        for expense in expenses:
-            total_resources -= p0[expense]
-        if abs(total_resources - p0["SPMTOTRES"])>10:
-            print(f"(CPSID: {hh['CPSID']}) {round(total_resources - p0['SPMTOTRES'],2)}")
-    # Only 5 households have family resource estimates off by >$10, and they are all off by 
-    # about $50. I can't figure out why, but I'm OK with that level of error
+    resources = compute_spm_resources(data)
+    for i in np.flatnonzero(np.abs(resources["difference"])>10):
+        print(f"(CPSID: {resources['CPSID'][i]}, SPMFAMUNIT: {resources['SPMFAMUNIT'][i]}) {round(resources['difference'][i],2)}")
+    # Only a handful of SPM units have family resource estimates off by >$10 (when checking only the 
+    # householders' units, 5 households, all off by about $50). I can't figure out why, but I'm OK with that level of error
+
+### SPM resource accounting
+
+def get_person_incomes(persons):
+    # Total income of each person (sum over the income_sources columns), only counting persons 15+ yo 
+    # (as SPM family resources do)
+    incomes = column_block(persons, list(income_sources), np.int64)
+    return incomes.sum(axis=1) * (column(persons, "AGE", np.int64) >= 15)
+
+def compute_spm_resources(data):
+    # Recompute total resources for every SPM family unit (persons grouped by CPSID + SPMFAMUNIT) from 
+    # the income_sources, in_kind_benefits and expenses columns, all at once:
+    #   total resources = incomes of all persons 15+ yo + unit-wide benefits - unit-wide expenses
+    # Unit-wide fields (benefits, expenses, SPMTOTRES, SPMTHRESH) are read from the first person in each unit.
+    # Returns a dictionary of arrays with one entry per unit: CPSID, SPMFAMUNIT, income, benefits, expenses, 
+    # SPMTOTRES (recomputed), SPMTOTRES_reported, difference (recomputed - reported) and spm_perc (recomputed).
+    cpsids = column(data, "CPSID")
+    spmfamunits = column(data, "SPMFAMUNIT")
+    _, cpsid_codes = np.unique(cpsids, return_inverse=True)
+    _, spmfamunit_codes = np.unique(spmfamunits, return_inverse=True)
+    unit_codes = cpsid_codes.reshape(-1) * (spmfamunit_codes.max(initial=0) + 1) + spmfamunit_codes.reshape(-1)
+    _, first, units = np.unique(unit_codes, return_index=True, return_inverse=True)
+    units = units.reshape(-1)
+
+    person_incomes = get_person_incomes(data)
+    income = np.bincount(units, weights=person_incomes, minlength=len(first))
+    unit_persons = [data[i] for i in first]
+    benefits = column_block(unit_persons, list(in_kind_benefits)).sum(axis=1)
+    expenses_total = column_block(unit_persons, list(expenses)).sum(axis=1)
+    total = income + benefits - expenses_total
+    reported = column(unit_persons, "SPMTOTRES", np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"): # units with a 0 threshold get inf/nan
+        spm_perc = total / column(unit_persons, "SPMTHRESH", np.float64) * 100
+    return {
+        "CPSID": cpsids[first], "SPMFAMUNIT": spmfamunits[first], 
+        "income": income, "benefits": benefits, "expenses": expenses_total, 
+        "SPMTOTRES": total, "SPMTOTRES_reported": reported, "difference": total - reported, 
+        "spm_perc": spm_perc
+    }
 
 ### Family profiles
 
@@ -713,7 +942,7 @@ def print_detailed_household_profile(hh):
 
 filepath_data = DATADIR + "raw/asec16r2.csv"
 filepath_dictionary = DATADIR + "dictionaries/asec16_dictionary_compact_extended_2.json"
-data = load_and_preprocess_asec_data(filepath_data, filepath_dictionary)
+data = load_and_preprocess_asec_data(filepath_data, filepath_dictionary, cache_dir=DATADIR + "cache/")
 explore_housing_family_doubling_up(data)
 
 print("Here!")
\ No newline at end of file
@@ -1,15 +1,33 @@
+import bz2
 import csv
+import gzip
+import hashlib
+import io
 import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
 import re
 import random
-from collections import Counter
+import shutil
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from functools import partial
+from itertools import chain
 from statistics import mean, median
 from math import floor, ceil, sqrt
+from operator import itemgetter
+import numpy as np
 
 verbose = True
 
 
-def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_detailed, filepath_out_compact):
+def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_detailed, filepath_out_compact, field_types = None):
     # Load a data dictionary that was generated by IPUMS (https://www.ipums.org/)
     # and convert it to our internal JSON format.
     # The output will actually be two JSON files:
@@ -17,6 +35,8 @@ def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_de
     #       the "fixed-width text file" format provided by IPUMS to a JSON, and
     #   2.  a "compact" data dictionary primarily used for decoding field values (mapping codes -> descriptions)
     #       during data analysis.
+    # field_types optionally maps field names to "int" or "float", for numeric fields which should be
+    # converted when the data is loaded (see get_field_converters). All other fields are loaded as strings.
 
     ### Example use:
     # datadir = "/Users/adona/data/census/timeuse/"
@@ -31,6 +51,9 @@ def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_de
     #     "5": "eldercare"
     # }
     # convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_detailed, filepath_out_compact)
+    # Or, to also mark some of the fields as numeric:
+    # field_types = {"AGE": "int", "WT06": "float"}
+    # convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_detailed, filepath_out_compact, field_types)
 
 
     ### Sample input file:  (the IPUMS "basic" version) 
@@ -107,12 +130,13 @@ def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_de
     
     # The structure is a dictionary mapping field names to either 
     #   - "string" for non-categorical variables
+    #   - "int" or "float" for numeric variables
     #   - the valid entries for categorical variables, represented as a dictionary of {code: description} pairs.
 
     log("Loading the IPUMS data dictionary.. ")
 
     data_dictionary = {}
-    with open(filepath_in_IPUMS, "r") as f:
+    with open_data_file(filepath_in_IPUMS) as f:
         # Find the beginning of the fields list (for now skip the dataset headers)
         while True:
             line = f.readline().strip()
@@ -188,6 +212,11 @@ def convert_data_dictionary_to_json(filepath_in_IPUMS, rectypes, filepath_out_de
         
     log("IPUMS data dictionary loaded.")
 
+    # Mark numeric fields
+    if field_types is not None:
+        for fname in field_types:
+            data_dictionary[fname]["field_type"] = field_types[fname]
+
 
     # Group fields by record type to generate the "detailed" version of the data dictionary.
     # Initialize the detailed data dictionary with empty field lists for each record type.
@@ -243,6 +272,357 @@ def parse_fixedwidth_datafile_line(line, data_dictionary_detailed, rectypes):
         record[field["name"]] = line[(field["start"]-1):field["end"]]
     return record
 
+class FixedWidthDecoder:
+    # Precompiled version of parse_fixedwidth_datafile_line, for when we need to parse millions of lines.
+    # The data dictionary is only walked once, when the decoder is built: each record type is compiled
+    # into a "slice plan" = a tuple of (interned) field names + a single itemgetter which cuts
+    # all the fields out of the line in one C-level call.
+    # Decoding a line then boils down to a dict lookup, one itemgetter call and one dict(zip(..)).
+    # The output is identical to parse_fixedwidth_datafile_line's.
+
+    ### Example use:
+    # data_dictionary_detailed = load_JSON(filepath_dictionary)
+    # decoder = FixedWidthDecoder(data_dictionary_detailed, RECTYPES)
+    # record = decoder.decode(line)
+
+    # With typed=True, the fields the data dictionary marks as "int" or "float" are converted while decoding
+    # (see get_field_converters), rather than in separate passes over the data afterwards.
+    # fields optionally restricts which fields get decoded for each record type, e.g. 
+    # {"household": ["CASEID", "FAMINCOME"], "person": ["AGE", "SEX"]}; fields which aren't requested are 
+    # never sliced out of the line. Record types missing from `fields` are decoded in full.
+    # filters optionally gives a filter spec (see compile_filters) for each record type, e.g. 
+    # {"person": {"AGE": lambda age: int(age) >= 15}}. accepts(line) checks a line against its record type's
+    # filters by slicing out only the filtered fields, so rejected lines never need to be decoded.
+
+    def __init__(self, data_dictionary_detailed, rectypes, typed = False, fields = None, filters = None):
+        self.rectypes = rectypes
+        self.layouts = {}  # rectype code (first character of the line) -> (field names, slicer, converters)
+        self.checks = {}   # rectype code -> [(slice, function to convert the value, condition)]
+        for (code, rectype) in rectypes.items():
+            if rectype not in data_dictionary_detailed: # No fields for this record type, so nothing to compile
+                continue
+            fields_rectype = data_dictionary_detailed[rectype]
+            if filters is not None and rectype in filters:
+                self.checks[code] = self.compile_checks(fields_rectype, filters[rectype], typed, rectype)
+            if fields is not None and rectype in fields:
+                fields_rectype = project_fields(fields_rectype, fields[rectype], rectype)
+            self.layouts[code] = self.compile_layout(fields_rectype, typed)
+
+    def compile_checks(self, fields, filters, typed, rectype):
+        checks = []
+        for field in project_fields(fields, list(filters.keys()), rectype):
+            convert = FIELD_CONVERTERS.get(field["field_type"], None) if typed else None
+            condition = compile_condition(filters[field["name"]])
+            checks.append((slice(field["start"]-1, field["end"]), convert, condition))
+        return checks
+
+    def accepts(self, line):
+        for (s, convert, condition) in self.checks.get(line[0], []):
+            value = line[s] if convert is None else convert(line[s])
+            if not condition(value):
+                return False
+        return True
+
+    def compile_layout(self, fields, typed):
+        names = tuple(sys.intern(field["name"]) for field in fields)
+        slices = [slice(field["start"]-1, field["end"]) for field in fields]
+        converters = []  # (index of the field, function to convert it)
+        if typed:
+            converters = [(i, FIELD_CONVERTERS[field["field_type"]]) for (i, field) in enumerate(fields) 
+                if field["field_type"] in FIELD_CONVERTERS]
+        return (names, compile_slicer(slices), converters)
+
+    def decode(self, line):
+        names, slicer, converters = self.layouts[line[0]]
+        values = slicer(line)
+        if converters:
+            values = list(values)
+            for (i, convert) in converters:
+                values[i] = convert(values[i])
+        return dict(zip(names, values))
+
+def project_fields(fields, requested_fields, rectype):
+    # Keep only the requested fields (in data dictionary order)
+    names = set(field["name"] for field in fields)
+    missing = [name for name in requested_fields if name not in names]
+    if len(missing) > 0:
+        raise ValueError("Fields not found in the data dictionary for " + rectype + " records: " + str(missing))
+    requested_fields = set(requested_fields)
+    return [field for field in fields if field["name"] in requested_fields]
+
+def compile_slicer(slices):
+    # Returns a function which applies all the slices to a line at once and returns a tuple of the results.
+    # itemgetter returns a tuple only when given 2+ items, so handle 0 and 1 separately.
+    if len(slices) == 0:
+        return lambda line: ()
+    elif len(slices) == 1:
+        s = slices[0]
+        return lambda line: (line[s],)
+    else:
+        return itemgetter(*slices)
+
+def benchmark_fixedwidth_decoder(lines, data_dictionary_detailed, rectypes, repeat=3):
+    # Compare parse_fixedwidth_datafile_line vs. FixedWidthDecoder on a list of raw lines:
+    # check that the two produce identical records, and report the decoding rate of each (best of `repeat` runs).
+    # Also reports the rate of the decoder's slicing step alone: most of what's left of decode's time 
+    # goes into building the output dicts, which both paths have to do, so the end-to-end speedup is 
+    # well below the slicing speedup (on ~100-field lines: ~1.3-1.9x end to end, vs. ~3.5-4.5x for slicing alone).
+
+    ### Example use:
+    # with open(datadir + "raw/atus16.dat", "r") as f:
+    #     lines = [line.strip() for line in f.readlines()[:200000]]
+    # benchmark_fixedwidth_decoder(lines, load_JSON(filepath_dictionary), RECTYPES)
+
+    decoder = FixedWidthDecoder(data_dictionary_detailed, rectypes)
+    for line in lines:
+        assert(decoder.decode(line) == parse_fixedwidth_datafile_line(line, data_dictionary_detailed, rectypes))
+
+    def best_time(parse):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            for line in lines:
+                parse(line)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    t_line = best_time(lambda line: parse_fixedwidth_datafile_line(line, data_dictionary_detailed, rectypes))
+    t_decoder = best_time(decoder.decode)
+    t_slicing = best_time(lambda line: decoder.layouts[line[0]][1](line))
+    log(f"parse_fixedwidth_datafile_line: {len(lines)/t_line :,.0f} lines/s")
+    log(f"FixedWidthDecoder: {len(lines)/t_decoder :,.0f} lines/s (slicing alone: {len(lines)/t_slicing :,.0f} lines/s)")
+    log(f"Speedup: {t_line/t_decoder :.1f}x")
+    return t_line / t_decoder
+
+### Parallel parsing of fixed-width data files
+
+def parse_fixedwidth_datafile_parallel(filepath, data_dictionary_detailed, rectypes, nest_records=None, 
+    nworkers=None, chunk_size=32*2**20, household_rectype="1", typed=False, fields=None, filters=None, process_records=None, 
+    max_pending=None):
+    # Parse a fixed-width data file using a pool of worker processes.
+    # The file is split into byte ranges of ~chunk_size bytes which each start at a household record 
+    # (see split_fixedwidth_datafile), so that every chunk contains only complete households and can be parsed independently.
+    # Each worker builds its own FixedWidthDecoder once, and then parses whole chunks. 
+    # The parsed records are yielded in the same order as in the file, so the output is identical to parsing 
+    # the file serially (as long as the file doesn't contain empty lines, which the serial path treats as EOF).
+    #   - nest_records: optional function (lines, decoder) -> records, used to assemble records into 
+    #       hierarchies (e.g. nest_timeuse_records). Must be defined at module level so it can be sent to the workers.
+    #       If None, the flat list of decoded records is returned.
+    #   - typed: convert numeric fields while decoding, see FixedWidthDecoder.
+    #   - fields: optional {rectype: [fields]} projection, see FixedWidthDecoder.
+    #   - filters: optional {rectype: filter spec}, see FixedWidthDecoder. Without nest_records, 
+    #       rejected records are simply dropped; nest_records decides what to do with them otherwise.
+    #   - process_records: optional function (records, chunk #) -> result, run in the worker on the records of each chunk 
+    #       (e.g. writing them out, see parse_fixedwidth_datafile_to_NDJSON). Only the (small) results are then sent back 
+    #       and yielded, one per chunk, in file order. Must be picklable (a module level function or a partial of one).
+    #   - max_pending: max number of chunks being parsed or waiting to be yielded at any time (defaults to 2 per worker), 
+    #       so memory is bounded by max_pending chunks' worth of records however fast the workers are.
+    # NOTE: Without process_records, every record gets pickled by a worker and unpickled by the main process, 
+    # one at a time. That's typically slower than decoding the records in the first place, so the main process is 
+    # the bottleneck and this is no faster (and can be much slower) than parsing serially. Use process_records 
+    # to get the work done in the workers.
+
+    ### Example use:
+    # data_dictionary_detailed = load_JSON(datadir + "dictionaries/atus16_dictionary_detailed.json")
+    # for household in parse_fixedwidth_datafile_parallel(datadir + "raw/atus16.dat", data_dictionary_detailed, 
+    #     RECTYPES, nest_records=nest_timeuse_records, nworkers=32):
+    #     ...
+
+    if nworkers is None:
+        nworkers = os.cpu_count()
+    if max_pending is None:
+        max_pending = 2 * nworkers
+    nchunks = max(1, ceil(os.path.getsize(filepath) / chunk_size))
+    chunks = split_fixedwidth_datafile(filepath, nchunks, household_rectype)
+    log(f"Parsing {filepath} in {len(chunks)} chunks with {nworkers} workers..")
+    with multiprocessing.Pool(nworkers, initializer=init_fixedwidth_worker, 
+        initargs=(data_dictionary_detailed, rectypes, typed, fields, filters)) as pool:
+        pending = deque() # Results of the chunks submitted to the workers, in file order
+        for (i, (start, end)) in enumerate(chunks):
+            pending.append(pool.apply_async(parse_fixedwidth_chunk, ((filepath, start, end, nest_records, process_records, i),)))
+            while len(pending) >= max_pending or (i == len(chunks)-1 and len(pending) > 0):
+                result = pending.popleft().get()
+                if process_records is None:
+                    yield from result
+                else:
+                    yield result
+
+def parse_fixedwidth_datafile_to_NDJSON(filepath, data_dictionary_detailed, rectypes, filepath_out, nest_records=None, 
+    nworkers=None, chunk_size=32*2**20, household_rectype="1", typed=False, fields=None, filters=None):
+    # Parse a fixed-width data file in parallel and save the records as newline-delimited JSON (see save_NDJSON). 
+    # Each worker writes the records of its chunks to its own shard file (<filepath_out>.partNNNNNN), 
+    # and the shards are then concatenated in file order, so records never need to be sent back to the main process. 
+    # The output is identical to save_NDJSON(parse_fixedwidth_datafile_parallel(..), filepath_out). 
+    # Returns the number of records saved.
+    log("Saving: " + filepath_out + "..")
+    shards = parse_fixedwidth_datafile_parallel(filepath, data_dictionary_detailed, rectypes, nest_records=nest_records, 
+        nworkers=nworkers, chunk_size=chunk_size, household_rectype=household_rectype, typed=typed, fields=fields, filters=filters, 
+        process_records=partial(save_NDJSON_shard, filepath_out))
+    nrecords = 0
+    with open(filepath_out, "wb") as f:
+        for (filepath_shard, nrecords_shard) in shards:
+            with open(filepath_shard, "rb") as shard:
+                shutil.copyfileobj(shard, f)
+            os.remove(filepath_shard)
+            nrecords += nrecords_shard
+    log("# records saved: " + str(nrecords))
+    return nrecords
+
+def save_NDJSON_shard(filepath, records, nchunk):
+    # Run by parse_fixedwidth_datafile_to_NDJSON's workers: save one chunk of records, see save_NDJSON
+    filepath_shard = filepath + f".part{nchunk :06d}"
+    with open(filepath_shard, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")))
+            f.write("\n")
+    return (filepath_shard, len(records))
+
+def split_fixedwidth_datafile(filepath, nchunks, household_rectype="1"):
+    # Split a fixed-width data file into (roughly) equal byte ranges [start, end), 
+    # moving each boundary forward to the beginning of the next household record.
+    check_not_compressed(filepath)
+    size = os.path.getsize(filepath)
+    household_rectype = household_rectype.encode()
+    offsets = [0]
+    with open(filepath, "rb") as f:
+        for i in range(1, nchunks):
+            pos = size * i // nchunks
+            if pos <= offsets[-1]: # Already covered by the previous chunk
+                continue
+            f.seek(pos - 1)
+            f.readline() # Skip to the beginning of the next line
+            while True: # Find the next household record
+                offset = f.tell()
+                line = f.readline()
+                if len(line) == 0 or line.startswith(household_rectype): # EOF or household
+                    break
+            if offset > offsets[-1] and offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+fixedwidth_worker_decoder = None # Set up once in each worker process by init_fixedwidth_worker
+
+def init_fixedwidth_worker(data_dictionary_detailed, rectypes, typed=False, fields=None, filters=None):
+    global fixedwidth_worker_decoder
+    fixedwidth_worker_decoder = FixedWidthDecoder(data_dictionary_detailed, rectypes, typed=typed, fields=fields, filters=filters)
+
+def parse_fixedwidth_chunk(task):
+    filepath, start, end, nest_records, process_records, nchunk = task
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start).decode()
+    lines = read_fixedwidth_lines(io.StringIO(chunk))
+    if nest_records is None:
+        records = [fixedwidth_worker_decoder.decode(line) for line in lines if fixedwidth_worker_decoder.accepts(line)]
+    else:
+        records = list(nest_records(lines, fixedwidth_worker_decoder))
+    if process_records is None:
+        return records
+    return process_records(records, nchunk)
+
+### Random access to households in fixed-width data files
+
+class HouseholdIndex:
+    # Random access to individual households in a fixed-width data file, without loading the entire file.
+    # The file is memory-mapped, and an index of {household key (e.g. SERIAL/CASEID): [start, end] byte offsets} 
+    # is used to jump straight to the lines of the requested household(s), which are then decoded on the fly. 
+    # The index is built once (see build_household_index) and saved beside the data file as <filepath>.idx.json;
+    # it gets rebuilt automatically if the data file changes.
+    #   - nest_records: optional function (lines, decoder) -> records used to assemble the household's records 
+    #       into a hierarchy (e.g. nest_timeuse_records). If None, households are returned as flat lists of records.
+    #   - typed: convert numeric fields while decoding, see FixedWidthDecoder.
+    #   - fields: optional {rectype: [fields]} projection, see FixedWidthDecoder.
+
+    ### Example use:
+    # index = HouseholdIndex(datadir + "raw/atus16.dat", data_dictionary_detailed, RECTYPES, "CASEID", nest_timeuse_records)
+    # household = index.get("20160101160045")
+    # households = index.get_many(random.sample(index.keys(), 100))
+
+    def __init__(self, filepath, data_dictionary_detailed, rectypes, key_field, nest_records=None, household_rectype="1", 
+        typed=False, fields=None):
+        self.decoder = FixedWidthDecoder(data_dictionary_detailed, rectypes, typed=typed, fields=fields)
+        self.nest_records = nest_records
+        self.offsets = load_household_index(filepath, data_dictionary_detailed, rectypes, key_field, household_rectype)
+        self.mm = None # Empty files can't be memory-mapped (and have no households to read anyway)
+        if os.path.getsize(filepath) > 0:
+            with open(filepath, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def keys(self):
+        return list(self.offsets.keys())
+
+    def get(self, key):
+        start, end = self.offsets[key]
+        lines = read_fixedwidth_lines(io.StringIO(self.mm[start:end].decode()))
+        if self.nest_records is None:
+            return [self.decoder.decode(line) for line in lines]
+        else:
+            return next(self.nest_records(lines, self.decoder))
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+def build_household_index(filepath, data_dictionary_detailed, rectypes, key_field, household_rectype="1"):
+    # Scan a memory-mapped fixed-width data file for household records, 
+    # and record the [start, end] byte offsets of each household, keyed by key_field (e.g. SERIAL/CASEID).
+    # Each household spans from its own household record to the next one.
+    # Raises a ValueError if the same key appears in more than one household record.
+    log("Building household index for: " + filepath + "..")
+    check_not_compressed(filepath)
+    field = [field for field in data_dictionary_detailed[rectypes[household_rectype]] if field["name"] == key_field][0]
+    key_start, key_end = field["start"]-1, field["end"]
+
+    starts = []
+    keys = []
+    size = os.path.getsize(filepath)
+    household_rectype = household_rectype.encode()
+    if size > 0: # Empty files can't be memory-mapped, and have no households
+        with open(filepath, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:1] == household_rectype:
+                    starts.append(0)
+                pos = mm.find(b"\n" + household_rectype) # Jump straight from one household record to the next
+                while pos != -1:
+                    starts.append(pos+1)
+                    pos = mm.find(b"\n" + household_rectype, pos+1)
+                keys = [mm[start+key_start:start+key_end].decode() for start in starts]
+    ends = starts[1:] + [size]
+    offsets = {key: [start, end] for (key, start, end) in zip(keys, starts, ends)}
+    if len(offsets) < len(keys):
+        duplicates = sorted(key for (key, count) in Counter(keys).items() if count > 1)
+        raise ValueError("Duplicate " + key_field + " in household records of " + filepath + ": " + str(duplicates[:10]) + 
+            (" (" + str(len(duplicates)) + " in total)" if len(duplicates) > 10 else ""))
+
+    # Save the index beside the data file, together with what we need to tell whether it's still valid
+    stat = os.stat(filepath)
+    index = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "key_field": key_field,
+        "offsets": offsets
+    }
+    with open(filepath + ".idx.json", "w") as f:
+        f.write(json.dumps(index))
+    log("# households indexed: " + str(len(offsets)))
+    return offsets
+
+def load_household_index(filepath, data_dictionary_detailed, rectypes, key_field, household_rectype="1"):
+    # Load the household index saved beside the data file, (re)building it if it's missing or stale.
+    filepath_index = filepath + ".idx.json"
+    if os.path.exists(filepath_index):
+        with open(filepath_index, "r") as f:
+            index = json.loads(f.read())
+        stat = os.stat(filepath)
+        if (index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns and index["key_field"] == key_field):
+            return index["offsets"]
+        log("Household index is out of date.")
+    return build_household_index(filepath, data_dictionary_detailed, rectypes, key_field, household_rectype)
+
 ### Compute basic statistics directly over the weighted dataset
 
 def weighted_len(data, weights_field):
@@ -263,24 +643,12 @@ def weighted_median(data, field, weights_field):
     if len(data) == 0:
         return None
     else: 
-        # Sort the data
-        sorted_data = sorted(data, key=lambda row: row[field])
-
-        # Calculate what the middle index of the expanded dataset would be
-        w_count = weighted_len(sorted_data, weights_field)
-        w_middle_idx = (w_count+1) // 2
-
-        # Start walking the unexpanded (weighted) dataset, adding up weights to calculate 
-        # what the index in the expanded dataset would be, until I reach w_middle_index
-        w_idx = 0
-        w_median = None
-        for d in sorted_data:
-            w_idx += d[weights_field]
-            if(w_idx >= w_middle_idx): # Found it!
-                w_median = d[field]
-                break
-
-        return w_median
+        # Sort the data once, then find the first row at which the running total of the weights 
+        # reaches the middle index of the expanded dataset (see search_weighted_quantiles)
+        order = np.argsort(np.array([d[field] for d in data]), kind="stable")
+        cumulative_weights = np.cumsum(np.array([data[i][weights_field] for i in order], dtype=np.float64))
+        idx = search_weighted_quantiles(cumulative_weights, [0.5])[0]
+        return data[order[idx]][field]
 
 def weighted_counter(data, field, weights_field):
     # Initialize counter to all zeros
@@ -307,70 +675,1152 @@ def weighted_counter(data, field, weights_field):
         entry["cumulative"] = cumulative
     return w_counter_list
 
-def compute_estimate_and_standard_error(f, weight_field, replicate_fields):
+def compute_estimate_and_standard_error(f, weight_field, replicate_fields, nworkers = 1):
     # All census datasets use a method based on replicate weights to compute 
     # standard error estimates. See explanation here: https://cps.ipums.org/cps/repwt.shtml
+    #   - nworkers: if > 1, the 160 replicate estimates are computed by a pool of worker processes 
+    #       (see compute_replicate_estimates_parallel). The results are identical to the serial loop.
 
     # Compute the estimate using the default weight
     estimate = f(weight_field)
     # Also re-compute the estimate using each replicate weight
     # and use them to compute the standard error
+    rws = [replicate_fields+str(i+1) for i in range(160)]
+    if nworkers > 1:
+        replicate_estimates = compute_replicate_estimates_parallel(f, rws, nworkers)
+    else:
+        replicate_estimates = map(f, rws)
     se = 0
-    for i in range(160):
-        rw = replicate_fields+str(i+1)
-        replicate_estimate = f(rw)
+    for replicate_estimate in replicate_estimates:
         se += (estimate - replicate_estimate) ** 2
     se = sqrt(4/160*se)
     return estimate, se
 
+replicate_estimator = None # The function being evaluated by compute_replicate_estimates_parallel, inherited by the workers
+
+def compute_replicate_estimates_parallel(f, rws, nworkers):
+    # Evaluate f(rw) for each replicate weight field using a pool of forked worker processes.
+    # f is usually a lambda closing over the dataset, which can't be pickled; instead it is stored in a 
+    # module global before the pool is forked, so the workers inherit it (and the dataset it refers to) 
+    # copy-on-write, and only the replicate weight field names and the estimates are sent between processes.
+    # The estimates are returned in the order of rws, so the standard error is summed in the same 
+    # order as in the serial loop. Falls back to the serial loop where fork isn't available (e.g. Windows).
+    global replicate_estimator
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return [f(rw) for rw in rws]
+    replicate_estimator = f
+    try:
+        with multiprocessing.get_context("fork").Pool(nworkers) as pool:
+            return pool.map(evaluate_replicate_estimator, rws, chunksize=ceil(len(rws)/nworkers))
+    finally:
+        replicate_estimator = None
+
+def evaluate_replicate_estimator(rw):
+    return replicate_estimator(rw)
+
+### Compute statistics for the main weight and all replicate weights at once
+
+class ReplicateWeights:
+    # Vectorized alternative to compute_estimate_and_standard_error: instead of re-running a function over 
+    # the dataset once per weight, keep the main weight and all the replicate weights together in an 
+    # (n x 161) matrix (column 0 = main weight, columns 1..160 = replicate weights), and compute weighted 
+    # statistics for all of them in one matrix operation. 
+    # Subsets of the data are described by boolean masks over the rows (see column()).
+    # Statistics return a vector of 161 estimates, which get_estimate_and_standard_error turns 
+    # into (estimate, standard error).
+
+    ### Example use:
+    # rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    # employed = column(data, "UHRSWORKT") != 999
+    # hours_vary = column(data, "UHRSWORKT") == 997
+    # perc, se = get_estimate_and_standard_error(rw.ratio(hours_vary, employed) * 100)
+
+    def __init__(self, data, weight_field, replicate_fields, nreplicates = 160):
+        # data: list of records, or dictionary of {field: column} (e.g. household-level columns)
+        weight_fields = [weight_field] + [replicate_fields+str(i+1) for i in range(nreplicates)]
+        if isinstance(data, dict):
+            self.weights = np.column_stack([np.asarray(data[wf], dtype=np.float64) for wf in weight_fields])
+        else:
+            self.weights = np.array([[d[wf] for wf in weight_fields] for d in data], dtype=np.float64).reshape(len(data), len(weight_fields))
+
+    def total(self, mask = None, values = None):
+        # Weighted count of the rows in mask (or all rows), or weighted sum of values over them
+        if values is None:
+            x = np.ones(len(self.weights)) if mask is None else np.asarray(mask, dtype=np.float64)
+        else:
+            x = np.asarray(values, dtype=np.float64)
+            if mask is not None:
+                x = np.where(mask, x, 0)
+        return x @ self.weights
+
+    def ratio(self, numerator_mask, denominator_mask):
+        # Weighted count of the rows in numerator_mask / weighted count of the rows in denominator_mask
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.total(numerator_mask) / self.total(denominator_mask)
+
+    def mean(self, values, mask = None):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.total(mask, values) / self.total(mask)
+
+def get_estimate_and_standard_error(replicate_estimates):
+    # Takes a vector of [estimate using the main weight, estimates using each of the replicate weights]
+    # and returns the estimate and its standard error (same formula as compute_estimate_and_standard_error).
+    # Also works on an (m x 161) matrix, returning m estimates and m standard errors.
+    replicate_estimates = np.asarray(replicate_estimates, dtype=np.float64)
+    estimate = replicate_estimates[..., 0]
+    nreplicates = replicate_estimates.shape[-1] - 1
+    se = np.sqrt(4/nreplicates * ((replicate_estimates[..., 1:] - estimate[..., None]) ** 2).sum(axis=-1))
+    if np.ndim(estimate) == 0:
+        return float(estimate), float(se)
+    return estimate, se
+
+def column(data, field, dtype = None):
+    # Extract a field from a list of records as a numpy array
+    return np.array([d[field] for d in data], dtype=dtype)
+
+def column_block(data, fields, dtype = np.float64):
+    # Extract several (numeric) fields from a list of records at once, as a (len(data) x len(fields)) matrix. 
+    # The values are read with one itemgetter call per record and streamed into the matrix, 
+    # which is about twice as fast as building it from a list of lists.
+    getter = itemgetter(*fields) if len(fields) > 1 else (lambda d: (d[fields[0]],))
+    values = chain.from_iterable(map(getter, data))
+    return np.fromiter(values, dtype=dtype, count=len(data)*len(fields)).reshape(len(data), len(fields))
+
+class WeightedGroupBy:
+    # Weighted counts (and sums of other fields) grouped by one or more key fields, for the main weight 
+    # and all the replicate weights. Each key is coded as integers once (np.unique), the codes of 
+    # several keys are combined into a single cell index, and the weights of all rows are accumulated 
+    # into their cell in a single pass (see group_totals), so crosstabs never materialize the 
+    # subset of rows in each cell.
+    # Results are arrays with one axis per key (in the order of the keys), indexed like self.levels.
+
+    ### Example use:
+    # rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    # poor_employed = (column(data, "spm_perc") <= 100) & (column(data, "WORKLY") == "2")
+    # jobs = WeightedGroupBy(rw, [column(data, "INDLY")], mask = poor_employed).counter()
+    # Two-way crosstab: % of employed persons in each industry, by poverty bin:
+    # poverty_bin = np.digitize(column(data, "spm_perc"), range(0, 701, 100))
+    # crosstab = WeightedGroupBy(rw, [column(data, "INDLY"), poverty_bin], mask = employed)
+    # perc, se = crosstab.share(axis = 0)
+
+    def __init__(self, replicate_weights, keys, mask = None, values = None):
+        # keys: list of arrays (one per key field), values: dict of field -> array of values to sum
+        weights = replicate_weights.weights
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            keys = [np.asarray(key)[mask] for key in keys]
+            weights = weights[mask]
+        self.levels = []
+        codes = []
+        for key in keys:
+            levels, key_codes = np.unique(np.asarray(key), return_inverse=True)
+            self.levels.append(levels)
+            codes.append(key_codes.reshape(-1))
+        self.shape = tuple(len(levels) for levels in self.levels)
+        cells = np.ravel_multi_index(codes, self.shape)
+        ncells = int(np.prod(self.shape))
+        self.counts = group_totals(cells, ncells, weights).reshape(self.shape + (-1,))
+        self.sums = {}
+        for field, field_values in (values or {}).items():
+            field_values = np.asarray(field_values, dtype=np.float64)
+            if mask is not None:
+                field_values = field_values[mask]
+            self.sums[field] = group_totals(cells, ncells, weights * field_values[:, None]).reshape(self.shape + (-1,))
+
+    def count(self):
+        return get_estimate_and_standard_error(self.counts)
+
+    def sum(self, field):
+        return get_estimate_and_standard_error(self.sums[field])
+
+    def mean(self, field):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.sums[field] / self.counts)
+
+    def share(self, axis = None):
+        # % of the total count in each cell. For crosstabs, axis = the key(s) to normalize over, 
+        # e.g. axis = 0 gives the distribution over the first key within each level of the second key.
+        if axis is None:
+            axis = tuple(range(len(self.shape)))
+        total = self.counts.sum(axis=axis, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.counts / total * 100)
+
+    def counter(self):
+        # Same output as weighted_counter (sorted descending by count, with % of the total count and 
+        # cumulative distribution), plus standard errors. Keys of crosstabs are tuples.
+        keys = []
+        for idx in np.ndindex(*self.shape):
+            key = tuple(levels[j].item() for levels, j in zip(self.levels, idx))
+            keys.append(key[0] if len(key) == 1 else key)
+        return build_counter_list(keys, self.counts.reshape(-1, self.counts.shape[-1]))
+
+def build_counter_list(keys, counts):
+    # keys: list of m keys, counts: (m x 161) matrix of their weighted counts.
+    # Returns the weighted_counter records (sorted descending by count) with standard errors.
+    perc = counts / counts.sum(axis=0) * 100
+    order = np.argsort(-counts[:, 0], kind="stable")
+    cumulative = np.cumsum(perc[order], axis=0)
+    count, count_se = get_estimate_and_standard_error(counts[order])
+    perc, perc_se = get_estimate_and_standard_error(perc[order])
+    cumulative, cumulative_se = get_estimate_and_standard_error(cumulative)
+    w_counter_list = []
+    for i, key_idx in enumerate(order):
+        w_counter_list.append({
+            "key": keys[key_idx],
+            "count": float(count[i]), "count_se": float(count_se[i]), 
+            "perc": float(perc[i]), "perc_se": float(perc_se[i]), 
+            "cumulative": float(cumulative[i]), "cumulative_se": float(cumulative_se[i])
+        })
+    return w_counter_list
+
+class WeightedBins:
+    # Weighted statistics by bins of a numeric field (e.g. poverty level), for the main weight and all 
+    # the replicate weights. Every row is assigned to its bin once (np.digitize); numerators and 
+    # denominators for all bins are then accumulated in a single pass (see group_totals), so the 
+    # cost doesn't depend on the number of bins.
+    # Bins are [bins[i], bins[i+1]); rows outside [bins[0], bins[-1]) are ignored.
+
+    ### Example use:
+    # rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    # poverty_bins = WeightedBins(rw, column(data, "spm_perc"), range(0, 701, 100))
+    # frac, se = poverty_bins.ratio(hours_vary, employed) # one fraction (and its SE) per bin
+
+    def __init__(self, replicate_weights, values, bins):
+        self.weights = replicate_weights.weights
+        self.bins = np.asarray(bins)
+        self.nbins = len(self.bins) - 1
+        bin_idx = np.digitize(values, self.bins) - 1
+        # Rows outside the bins all go into an extra bin at the end, which gets dropped
+        self.bin_idx = np.where((bin_idx >= 0) & (bin_idx < self.nbins), bin_idx, self.nbins)
+
+    def totals(self, mask = None, values = None):
+        # Weighted count of the rows in mask (or all rows), or weighted sum of values over them, 
+        # per bin: returns an (nbins x 161) matrix
+        weights = self.weights
+        if values is not None:
+            weights = weights * np.asarray(values, dtype=np.float64)[:, None]
+        bin_idx = self.bin_idx
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            bin_idx, weights = bin_idx[mask], weights[mask]
+        return group_totals(bin_idx, self.nbins + 1, weights)[:-1]
+
+    def ratio(self, numerator_mask, denominator_mask):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.totals(numerator_mask) / self.totals(denominator_mask))
+
+    def mean(self, values, mask = None):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.totals(mask, values) / self.totals(mask))
+
+def group_totals(groups, ngroups, weights):
+    # Sum the rows of an (n x m) weight matrix by group: returns an (ngroups x m) matrix
+    return np.stack([np.bincount(groups, weights=weights[:, j], minlength=ngroups) for j in range(weights.shape[1])], axis=1)
+
+class WeightedQuantiles:
+    # Weighted quantiles (median, deciles, percentiles, ..) of a field for the main weight and all 
+    # the replicate weights. The values are sorted once and the order permutation kept, so 
+    # any number of quantiles, over any subset of the rows, only cost a cumulative sum of the 
+    # weights in sorted order + a binary search per quantile (instead of one sort per weight).
+
+    ### Example use:
+    # rw = ReplicateWeights(data, "ASECWT", "REPWTP")
+    # wq = WeightedQuantiles(rw, column(data, "INCTOT"))
+    # median, se = wq.median(mask = column(data, "WKSWORK1") >= 50)
+    # deciles, se = wq.quantiles([0.1*i for i in range(1, 10)])
+
+    def __init__(self, replicate_weights, values):
+        self.weights = replicate_weights.weights
+        self.order = np.argsort(values, kind="stable")
+        self.sorted_values = np.asarray(values)[self.order]
+
+    def quantiles(self, qs, mask = None):
+        # Returns (estimates, standard errors), one per quantile in qs. 
+        # If mask selects no rows the quantiles are undefined (nan).
+        sorted_weights = self.weights[self.order]
+        if mask is not None:
+            sorted_weights = sorted_weights * np.asarray(mask, dtype=np.float64)[self.order, None]
+        cumulative_weights = np.cumsum(sorted_weights, axis=0)
+        replicate_estimates = np.full((len(qs), sorted_weights.shape[1]), np.nan)
+        if len(cumulative_weights) > 0:
+            for j in range(sorted_weights.shape[1]):
+                if cumulative_weights[-1, j] > 0:
+                    idx = search_weighted_quantiles(cumulative_weights[:, j], qs)
+                    replicate_estimates[:, j] = self.sorted_values[idx]
+        return get_estimate_and_standard_error(replicate_estimates)
+
+    def median(self, mask = None):
+        estimates, se = self.quantiles([0.5], mask)
+        return float(estimates[0]), float(se[0])
+
+def search_weighted_quantiles(cumulative_weights, qs):
+    # Given the running total of the weights over the sorted values, return the index of each quantile q:
+    # the first row at which the running total reaches the index q * (n-1) + 1 in the expanded dataset
+    # (for the median, (n+1) // 2, same as weighted_median).
+    total = cumulative_weights[-1]
+    targets = np.floor(np.asarray(qs, dtype=np.float64) * (total - 1) + 1)
+    idx = np.searchsorted(cumulative_weights, targets, side="left")
+    return np.minimum(idx, len(cumulative_weights) - 1)
+
+### Memoized weighted statistics
+
+class EstimateCache:
+    # Memoizes (estimate, standard error) of weighted statistics over subsets of a dataset, so that re-running 
+    # an analysis (e.g. while tweaking plots in an interactive session) returns instantly.
+    # Entries are keyed by: the identity of the dataset, a canonical description of the subset (a filter spec, 
+    # see compile_filters), the statistic, the field and the weights. A cache hit never touches the data. 
+    # The identity of the dataset is (cheapest first):
+    #   - dataset_version: a token chosen by the caller (e.g. ("asec16", 1)), to be changed whenever the data changes. 
+    #       Only these entries (and verified ones) are kept by save(), so they can be reused in later sessions.
+    #   - otherwise, the dataset object itself (id + # of rows) and the cache's version: call invalidate() after 
+    #       modifying a dataset in place. The cache keeps a reference to these datasets, so their ids can't be reused.
+    #   - verify=True: a fingerprint of the content (hash of the field, the filter fields, the main weight 
+    #       and all the replicate weights, see fingerprint_dataset). Safe, but takes a full pass over the data.
+    # The weight matrix (see ReplicateWeights) is only built on a cache miss (or to verify).
+    #   - maxsize: max number of entries; the least recently used ones are evicted first.
+    #   - filepath: optional pickle file to persist the cache between sessions (loaded here, written by save()).
+    # Filter specs with function conditions can't be described canonically, so those estimates are not cached.
+
+    ### Example use:
+    # estimate_cache = EstimateCache(filepath = DATADIR + "cache/estimates.pickle")
+    # mean_income, se = estimate_cache.estimate(data, "mean", "INCTOT", filters = {"WORKLY": "2"}, dataset_version = "asec16")
+    # estimate_cache.save()
+
+    STATISTICS = ["count", "sum", "mean", "median"]
+
+    def __init__(self, maxsize = 1024, filepath = None):
+        self.maxsize = maxsize
+        self.filepath = filepath
+        self.entries = OrderedDict()
+        self.version = 0
+        self.datasets = {} # id -> dataset, for the entries keyed by dataset object
+        if filepath is not None and os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                self.entries = pickle.load(f)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def estimate(self, data, statistic, field = None, filters = None, weight_field = "ASECWT", replicate_fields = "REPWTP", 
+        dataset_version = None, verify = False):
+        assert statistic in self.STATISTICS, "Unknown statistic: " + statistic
+        subset = describe_filters(filters)
+        rw = None
+        if verify:
+            rw = ReplicateWeights(data, weight_field, replicate_fields)
+            dataset = ("fingerprint", fingerprint_dataset(data, [field] + sorted(filters or {}), rw.weights))
+        elif dataset_version is not None:
+            dataset = ("version", dataset_version)
+        else:
+            dataset = ("object", id(data), len(data), self.version)
+        key = (dataset, subset, statistic, field, weight_field, replicate_fields)
+        if subset is not None and key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if rw is None:
+            rw = ReplicateWeights(data, weight_field, replicate_fields)
+        mask = np.ones(len(data), dtype=bool)
+        for (filter_field, condition) in (filters or {}).items():
+            condition = compile_condition(condition)
+            mask &= np.fromiter((condition(d[filter_field]) for d in data), dtype=bool, count=len(data))
+        if statistic == "count":
+            result = get_estimate_and_standard_error(rw.total(mask))
+        elif statistic == "sum":
+            result = get_estimate_and_standard_error(rw.total(mask, column(data, field, np.float64)))
+        elif statistic == "mean":
+            result = get_estimate_and_standard_error(rw.mean(column(data, field, np.float64), mask))
+        elif statistic == "median":
+            result = WeightedQuantiles(rw, column(data, field)).median(mask)
+
+        if subset is not None:
+            if dataset[0] == "object":
+                self.datasets[id(data)] = data
+            self.entries[key] = result
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return result
+
+    def invalidate(self):
+        # Forget the entries keyed by dataset object (e.g. after modifying a dataset in place)
+        self.version += 1
+        self.datasets.clear()
+
+    def save(self):
+        # Entries keyed by dataset object are only valid for this session, so they're not saved
+        if self.filepath is not None:
+            entries = OrderedDict((key, result) for (key, result) in self.entries.items() if key[0][0] != "object")
+            os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+            with open(self.filepath + ".tmp", "wb") as f:
+                pickle.dump(entries, f)
+            os.replace(self.filepath + ".tmp", self.filepath)
+
+    def clear(self):
+        self.entries.clear()
+        self.invalidate()
+
+def describe_filters(filters):
+    # Canonical (hashable, order-independent) description of a filter spec, 
+    # or None if it contains function conditions
+    if filters is None:
+        return ()
+    description = []
+    for field in sorted(filters):
+        condition = filters[field]
+        if callable(condition):
+            return None
+        elif isinstance(condition, (list, tuple, set, frozenset)):
+            description.append((field, "in", tuple(sorted(set(condition), key=repr))))
+        else:
+            description.append((field, "==", condition))
+    return tuple(description)
+
+def fingerprint_dataset(data, fields, weights):
+    # Number of rows + hash of the values of the fields and of the weight matrix (see ReplicateWeights)
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(weights).tobytes())
+    for field in fields:
+        if field is not None:
+            sha1.update(field.encode())
+            sha1.update(repr([d[field] for d in data]).encode())
+    return (len(data), sha1.hexdigest())
+
+### Streaming accumulators for weighted statistics over chunked data
+
+class WeightedAccumulator:
+    # Base class for weighted statistics that are computed incrementally, chunk by chunk, for the 
+    # main weight and all the replicate weights, without ever holding the whole dataset in memory. 
+    # Accumulators of the same kind can be merged (e.g. partial results from different workers / files).
+    #   - update(records): add a chunk of records (list of dicts)
+    #   - merge(other): add the records seen by another accumulator of the same kind
+    #   - finalize(): (estimate, standard error)
+
+    ### Example use:
+    # mean_income = WeightedMean("INCTOT", "ASECWT", "REPWTP")
+    # for chunk in chunks: # e.g. one year of a multi-year extract at a time
+    #     mean_income.update(chunk)
+    # estimate, se = mean_income.finalize()
+
+    def __init__(self, weight_field, replicate_fields, nreplicates = 160):
+        self.weight_field = weight_field
+        self.replicate_fields = replicate_fields
+        self.nreplicates = nreplicates
+
+    def get_weights(self, records):
+        return ReplicateWeights(records, self.weight_field, self.replicate_fields, self.nreplicates).weights
+
+    def check_mergeable(self, other):
+        assert type(self) == type(other) and self.get_config() == other.get_config(), "Can only merge accumulators of the same kind"
+
+    def get_config(self):
+        return (self.weight_field, self.replicate_fields, self.nreplicates)
+
+class WeightedCount(WeightedAccumulator):
+    def __init__(self, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.count = np.zeros(nreplicates + 1)
+
+    def update(self, records):
+        self.count += self.get_weights(records).sum(axis=0)
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        self.count += other.count
+
+    def finalize(self):
+        return get_estimate_and_standard_error(self.count)
+
+class WeightedSum(WeightedAccumulator):
+    def __init__(self, field, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.field = field
+        self.sum = np.zeros(nreplicates + 1)
+
+    def get_config(self):
+        return (self.field,) + super().get_config()
+
+    def update(self, records):
+        self.sum += column(records, self.field, np.float64) @ self.get_weights(records)
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        self.sum += other.sum
+
+    def finalize(self):
+        return get_estimate_and_standard_error(self.sum)
+
+class WeightedMean(WeightedAccumulator):
+    def __init__(self, field, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.field = field
+        self.count = np.zeros(nreplicates + 1)
+        self.sum = np.zeros(nreplicates + 1)
+
+    def get_config(self):
+        return (self.field,) + super().get_config()
+
+    def update(self, records):
+        weights = self.get_weights(records)
+        self.count += weights.sum(axis=0)
+        self.sum += column(records, self.field, np.float64) @ weights
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        self.count += other.count
+        self.sum += other.sum
+
+    def finalize(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.sum / self.count)
+
+class WeightedVariance(WeightedAccumulator):
+    # Weighted (population) variance. Keeps the total weight, mean and sum of squared deviations from 
+    # the mean for each weight, and combines chunks with the parallel algorithm of Chan et al., 
+    # which is numerically stable (unlike accumulating sums of squares).
+    def __init__(self, field, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.field = field
+        self.count = np.zeros(nreplicates + 1)
+        self.mean = np.zeros(nreplicates + 1)
+        self.m2 = np.zeros(nreplicates + 1)
+
+    def get_config(self):
+        return (self.field,) + super().get_config()
+
+    def update(self, records):
+        if len(records) == 0:
+            return
+        weights = self.get_weights(records)
+        values = column(records, self.field, np.float64)
+        count = weights.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.nan_to_num(values @ weights / count)
+        m2 = ((values[:, None] - mean) ** 2 * weights).sum(axis=0)
+        self.combine(count, mean, m2)
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        self.combine(other.count, other.mean, other.m2)
+
+    def combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0)
+        self.count = total
+
+    def finalize(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return get_estimate_and_standard_error(self.m2 / self.count)
+
+class WeightedCounter(WeightedAccumulator):
+    # Streaming version of weighted_counter; finalize returns the same records plus standard errors.
+    def __init__(self, field, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.field = field
+        self.counts = {}
+
+    def get_config(self):
+        return (self.field,) + super().get_config()
+
+    def update(self, records):
+        if len(records) == 0:
+            return
+        levels, codes = np.unique(column(records, self.field), return_inverse=True)
+        counts = group_totals(codes.reshape(-1), len(levels), self.get_weights(records))
+        for level, count in zip(levels.tolist(), counts):
+            self.add(level, count)
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        for key, count in other.counts.items():
+            self.add(key, count)
+
+    def add(self, key, count):
+        if key in self.counts:
+            self.counts[key] = self.counts[key] + count
+        else:
+            self.counts[key] = count.copy()
+
+    def finalize(self):
+        keys = list(self.counts.keys())
+        if len(keys) == 0:
+            return []
+        return build_counter_list(keys, np.array([self.counts[key] for key in keys]))
+
+class WeightedHistogram(WeightedAccumulator):
+    # Weighted counts per bin [bins[i], bins[i+1]); finalize returns (estimates, standard errors), one per bin.
+    def __init__(self, field, bins, weight_field, replicate_fields, nreplicates = 160):
+        super().__init__(weight_field, replicate_fields, nreplicates)
+        self.field = field
+        self.bins = np.asarray(bins)
+        self.counts = np.zeros((len(self.bins) - 1, nreplicates + 1))
+
+    def get_config(self):
+        return (self.field, tuple(self.bins.tolist())) + super().get_config()
+
+    def update(self, records):
+        if len(records) == 0:
+            return
+        rw = ReplicateWeights(records, self.weight_field, self.replicate_fields, self.nreplicates)
+        self.counts += WeightedBins(rw, column(records, self.field), self.bins).totals()
+
+    def merge(self, other):
+        self.check_mergeable(other)
+        self.counts += other.counts
+
+    def finalize(self):
+        return get_estimate_and_standard_error(self.counts)
+
 ### Generate unweighted dataset by expanding and subsampling the data
 
-def expand_and_subsample_data(data, weights_field, subsampling_factor, randseed = None):
-    if subsampling_factor < 1:
+def expand_and_subsample_data(data, weights_field, subsampling_factor, randseed = None, target_size = None, shard = None):
+    # Builds an unweighted dataset, as if every row was copied weight times ("expanded dataset") and each copy 
+    # was then kept with probability subsampling_factor. Instead of drawing a random number per copy, the number of 
+    # copies of each row is drawn directly: Binomial(weight, subsampling_factor) for integer weights, 
+    # Poisson(weight * subsampling_factor) for float weights. So the cost is O(rows), no matter how large the weights.
+    #   - target_size: if given, draw exactly target_size copies, without replacement, from the expanded dataset 
+    #       (multivariate hypergeometric); subsampling_factor is ignored. Float weights are rounded to integers.
+    #       numpy's multivariate hypergeometric only handles expanded datasets of < 10^9 copies, so for larger ones 
+    #       (e.g. pooled multi-year weights) the copies are picked directly, see draw_copies_without_replacement.
+    #   - shard: for datasets processed in shards (e.g. in parallel), seeds shard i with [randseed, i], 
+    #       so every shard gets an independent random stream which is reproducible on its own.
+    if target_size is not None:
+        log("Expanding and subsampling the dataset to " + str(target_size) + " records...")
+    elif subsampling_factor < 1:
         log("Expanding and subsampling the dataset with a subsampling factor = " + str(subsampling_factor) + " ...")
     else: 
         log("Expanding dataset... ")
 
-    es_data = []
-    random.seed(randseed)
-    nrows = 0
-    for row in data:
-        weight = row[weights_field] # = number of copies of this datapoint in the expanded dataset
-        for i in range(weight): # for each copy
-            if (random.random() < subsampling_factor): # subsample
-                es_data.append(row)
-        nrows += 1
-        if (nrows % 10000 == 0):
-            log("Record #: " + str(nrows))
-            
+    if shard is not None and randseed is not None:
+        rng = np.random.default_rng([randseed, shard])
+    else:
+        rng = np.random.default_rng(randseed)
+    weights = column(data, weights_field) # = number of copies of each datapoint in the expanded dataset
+    if len(data) == 0:
+        copies = np.zeros(0, dtype=np.int64)
+    elif target_size is not None:
+        counts = np.rint(weights).astype(np.int64)
+        if counts.sum() < 10**9:
+            copies = rng.multivariate_hypergeometric(counts, target_size)
+        else:
+            copies = draw_copies_without_replacement(counts, target_size, rng)
+    elif weights.dtype.kind in "iu":
+        copies = rng.binomial(weights, subsampling_factor) if subsampling_factor < 1 else weights
+    else:
+        copies = rng.poisson(weights * subsampling_factor)
+    es_data = [data[i] for i in np.repeat(np.arange(len(data)), copies).tolist()]
+
     log("Expanding and subsampling complete.")    
     log("Initial # records: " + str(len(data)))
     log("Final # records: " + str(len(es_data)))
     return es_data
 
+def draw_copies_without_replacement(counts, size, rng):
+    # Multivariate hypergeometric draw for any total # of copies: pick size distinct positions in the expanded 
+    # dataset (row i owning counts[i] consecutive positions) uniformly at random, and count the positions of each row.
+    # Takes O(rows + size) time and memory as long as size is small compared to the expanded dataset (< 1/50 of it, 
+    # see numpy's Generator.choice).
+    positions = rng.choice(int(counts.sum()), size, replace=False)
+    rows = np.searchsorted(np.cumsum(counts), positions, side="right")
+    return np.bincount(rows, minlength=len(counts))
+
+### Reading (possibly compressed) data files
+
+# Magic bytes at the beginning of compressed files -> module to decompress them with
+COMPRESSION_FORMATS = [
+    (b"\x1f\x8b", gzip),               # .gz
+    (b"BZh", bz2),                      # .bz2
+    (b"\xfd7zXZ\x00", lzma)             # .xz
+]
+
+def open_data_file(filepath, readahead = True):
+    # Open a data file (.dat, .csv, .cbk, ..) for reading as text, whether it's compressed or not. 
+    # The compression format (gzip, bzip2 or xz) is detected from the first few bytes of the file, 
+    # so the file extension doesn't matter. Compressed files are decompressed on the fly as they are read: 
+    # with readahead=True, decompression runs in a background thread (see ReadAheadReader), 
+    # overlapping with the parsing done by the caller.
+
+    ### Example use:
+    # with open_data_file(datadir + "raw/atus16.dat.gz") as f:
+    #     for line in read_fixedwidth_lines(f):
+    #         ...
+
+    compression = get_compression(filepath)
+    if compression is None:
+        return open(filepath, "r")
+    raw = compression.open(filepath, "rb")
+    if readahead:
+        raw = io.BufferedReader(ReadAheadReader(raw))
+    return io.TextIOWrapper(raw)
+
+def get_compression(filepath):
+    # Returns the module to decompress the file with, or None if the file isn't compressed
+    with open(filepath, "rb") as f:
+        magic = f.read(6)
+    for (prefix, compression) in COMPRESSION_FORMATS:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+def check_not_compressed(filepath):
+    # Byte offsets (for parallel parsing, household indexes, ..) only make sense in uncompressed files
+    if get_compression(filepath) is not None:
+        raise ValueError(filepath + " is compressed: decompress it first to access it by byte offset.")
+
+class ReadAheadReader(io.RawIOBase):
+    # Wraps a binary file object, and reads it ahead in a background thread, in chunks of chunk_size bytes.
+    # Up to max_chunks chunks get buffered, waiting to be consumed. For compressed files, this means 
+    # decompression (which releases the GIL) runs in parallel with whatever the main thread does with the data.
+
+    def __init__(self, f, chunk_size = 1 << 20, max_chunks = 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk = memoryview(b"")
+        self.eof = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self.read_ahead, daemon=True)
+        self.thread.start()
+
+    def read_ahead(self):
+        try:
+            while not self.stopping:
+                chunk = self.f.read(self.chunk_size)
+                self.put(chunk)
+                if len(chunk) == 0: # EOF
+                    break
+        except Exception as e: # Pass the error on to the reading thread
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopping:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.chunk) == 0:
+            if self.eof:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if len(chunk) == 0:
+                self.eof = True
+                return 0
+            self.chunk = memoryview(chunk)
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopping = True
+            self.thread.join()
+            self.f.close()
+        super().close()
+
 ### Misc helper functions
 
-def load_csv_data(filepath, fields = "All"):
+def read_fixedwidth_lines(f):
+    # Yield the lines of a fixed-width data file one at a time (stripped of whitespace),
+    # stopping at the first empty line / EOF.
+    while True:
+        line = f.readline().strip()
+        if len(line) == 0:
+            break
+        yield line
+
+def load_csv_data(filepath, fields = "All", cache_dir = None, data_dictionary = None, filters = None):
+    # If a (compact) data_dictionary is given, the fields it marks as "int" or "float" are converted
+    # as they are read (see get_field_converters); all other fields are loaded as strings.
+    # If a cache_dir is given, the data is loaded through the columnar cache (see load_csv_columns). 
+    # NOTE: this gives no real speedup for rows: the rows still get rebuilt from the cached columns on every load, 
+    # which costs about as much as parsing the CSV (e.g. 1.5s vs. 1.9s uncached for 20k rows x 400 fields), 
+    # and the first load (which fills the cache) takes about twice as long as an uncached one. 
+    # Only load_csv_columns, which memory-maps the cached columns, loads near-instantly from the cache: 
+    # use it directly where the data can be consumed as columns (e.g. ReplicateWeights, HouseholdColumns).
+    # If filters are given, only the rows which pass them get loaded (see compile_filters); 
+    # the filters are checked before the row gets built, so rejected rows never take up any memory.
+
+    ### Example use:
+    # Only load persons who worked last year, full time:
+    # data = load_csv_data(filepath, fields, filters = {"WORKLY": "2", "FULLPART": "1"})
+
+    if cache_dir is not None:
+        data = columns_to_rows(load_csv_columns(filepath, fields, cache_dir, data_dictionary, filters))
+        log("# of records: " + str(len(data)))
+        return data
+
     log("Loading data from: " + filepath + "..")
     log("Loading fields: " + str(fields))
+    if filters is not None:
+        log("Filtering rows by: " + str(list(filters.keys())))
             
-    with open(filepath, "r") as f:
-        r = csv.DictReader(f)
+    with open_data_file(filepath) as f:
+        r = csv.reader(f)
+        header = next(r)
+        if fields == "All":
+            fields = header
+        idx = [header.index(field) for field in fields]
+        converters = [(fields.index(field), convert) for (field, convert) in get_field_converters(data_dictionary, fields)]
+        accepts = compile_filters(filters, header, data_dictionary)
         data = []
         nrows = 0
         for row in r:
-            if(fields == 'All'):
-                data.append(row)
-            else:
-                data.append({field: row[field] for field in fields})
+            if len(row) == 0: # Skip blank lines
+                continue
             nrows += 1
             if (nrows % 10000 == 0):
                 log("Record #: " + str(nrows))
+            if accepts is not None and not accepts(row):
+                continue
+            values = [row[j] for j in idx]
+            for (i, convert) in converters:
+                values[i] = convert(values[i])
+            data.append(dict(zip(fields, values)))
         log("Finished loading file: " + filepath)
         log("# of records: " + str(len(data)))
     
     return data
 
+### Filtering rows while loading
+
+def compile_filters(filters, header, data_dictionary = None):
+    # Compile a declarative filter spec into a function which takes a raw row (a list of strings, 
+    # in the order given by `header`) and returns whether the row passes all the filters.
+    # The filter spec is a dictionary of {field: condition}, where the condition is either 
+    #   - a value, e.g. {"WORKLY": "2"}
+    #   - a list/set of accepted values, e.g. {"CLASSWLY": ["22", "25", "27", "28"]}
+    #   - a function of the value returning True/False, e.g. {"CPSIDP": lambda v: v != "0"}
+    # Conditions apply to values as they get loaded, i.e. converted to int/float if the data dictionary says so.
+    # Returns None if there are no filters.
+    if filters is None or len(filters) == 0:
+        return None
+    checks = []
+    for field in filters:
+        convert = FIELD_CONVERTERS.get(get_field_type(data_dictionary, field), None)
+        checks.append((header.index(field), convert, compile_condition(filters[field])))
+
+    def accepts(row):
+        for (i, convert, condition) in checks:
+            value = row[i] if convert is None else convert(row[i])
+            if not condition(value):
+                return False
+        return True
+    return accepts
+
+def compile_condition(condition):
+    if callable(condition):
+        return condition
+    elif isinstance(condition, (list, tuple, set, frozenset)):
+        values = set(condition)
+        return lambda value: value in values
+    else:
+        return lambda value: value == condition
+
+def filter_columns(columns, filters):
+    # Apply a filter spec (see compile_filters) to a dictionary of {field: column}, returning the rows that pass
+    mask = np.ones(len(next(iter(columns.values()))), dtype=bool) if len(columns) > 0 else np.ones(0, dtype=bool)
+    for field in filters:
+        column = columns[field]
+        condition = filters[field]
+        if callable(condition):
+            mask &= np.fromiter((condition(value) for value in from_column(column)), dtype=bool, count=len(column))
+        else:
+            values = list(condition) if isinstance(condition, (list, tuple, set, frozenset)) else [condition]
+            if column.dtype.kind == "S":
+                values = [value.encode() for value in values]
+            mask &= np.isin(column, values)
+    return {field: column[mask] for (field, column) in columns.items()}
+
+### Columnar cache for loaded datasets
+
+def load_csv_columns(filepath, fields = "All", cache_dir = None, data_dictionary = None, filters = None):
+    # Load a CSV file as a dictionary of {field: column}, where each column is a numpy array.
+    # If a cache_dir is given, the columns are saved there as .npy files after the first load, 
+    # and memory-mapped straight from the cache on later loads.
+    # Cache entries are keyed by the contents of the source file, the list of fields and the data dictionary,
+    # so a change to any of them results in a new entry; the entry it replaces is deleted. 
+    # Filters (see compile_filters) are applied while parsing; when loading through the cache, the cache holds
+    # all the rows and the filters are applied to the cached columns instead, so they can change between runs.
+
+    ### Example use:
+    # columns = load_csv_columns(datadir + "raw/asec16r2.csv", ["AGE", "SEX", "ASECWT"], 
+    #     cache_dir = datadir + "cache/", data_dictionary = data_dictionary_compact)
+
+    if cache_dir is None:
+        return read_csv_columns(filepath, fields, data_dictionary, filters)
+
+    if filters is not None and len(filters) > 0:
+        # Load the fields the filters need along with the requested fields, and drop them again after filtering
+        extra_fields = [] if fields == "All" else [field for field in filters if field not in fields]
+        columns = load_csv_columns(filepath, fields if fields == "All" else fields + extra_fields, cache_dir, data_dictionary)
+        columns = filter_columns(columns, filters)
+        return {field: column for (field, column) in columns.items() if field not in extra_fields}
+
+    key = get_cache_key(filepath, fields, cache_dir, data_dictionary)
+    cache_path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(cache_path, "manifest.json")):
+        log("Loading cached columns from: " + cache_path + "..")
+        with open(os.path.join(cache_path, "manifest.json"), "r") as f:
+            manifest = json.loads(f.read())
+        return {field: np.load(os.path.join(cache_path, field + ".npy"), mmap_mode="r") for field in manifest["fields"]}
+
+    columns = read_csv_columns(filepath, fields, data_dictionary)
+    log("Saving columns to cache: " + cache_path + "..")
+    # Write to a temporary directory first, so a crash halfway through never leaves a partial cache entry behind
+    tmp_path = cache_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for field in columns:
+        np.save(os.path.join(tmp_path, field + ".npy"), columns[field])
+    manifest = {
+        "source": os.path.abspath(filepath),
+        "fields": list(columns.keys()),
+        "requested_fields": fields
+    }
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        f.write(json.dumps(manifest, indent=2))
+    remove_stale_cache_entries(cache_dir, manifest)
+    os.replace(tmp_path, cache_path)
+    return columns
+
+def read_csv_columns(filepath, fields = "All", data_dictionary = None, filters = None):
+    log("Loading data from: " + filepath + "..")
+    log("Loading fields: " + str(fields))
+    with open_data_file(filepath) as f:
+        r = csv.reader(f)
+        header = next(r)
+        if fields == "All":
+            fields = header
+        idx = [header.index(field) for field in fields]
+        types = [get_field_type(data_dictionary, field) for field in fields]
+        convert = [FIELD_CONVERTERS.get(ftype, str.encode) for ftype in types]
+        accepts = compile_filters(filters, header, data_dictionary)
+        values = [[] for field in fields]
+        nrows = 0
+        for row in r:
+            if len(row) == 0: # Skip blank lines
+                continue
+            if accepts is not None and not accepts(row):
+                continue
+            for (i, j) in enumerate(idx):
+                values[i].append(convert[i](row[j]))
+            nrows += 1
+            if (nrows % 10000 == 0):
+                log("Record #: " + str(nrows))
+    log("Finished loading file: " + filepath)
+    return {field: to_column(values[i], types[i]) for (i, field) in enumerate(fields)}
+
+def to_column(values, field_type = "string"):
+    # Numeric fields are stored as int64/float64 columns. 
+    # Strings are stored as UTF-8 bytes (dtype "S"), which take a quarter of the space of numpy's unicode strings
+    if field_type == "int":
+        return np.array(values, dtype=np.int64)
+    elif field_type == "float":
+        return np.array(values, dtype=np.float64)
+    else:
+        return np.array(values, dtype="S")
+
+def from_column(column):
+    if column.dtype.kind == "S":
+        return [v.decode() for v in column.tolist()]
+    else:
+        return column.tolist()
+
+def columns_to_rows(columns):
+    # Convert a dictionary of {field: column} to a list of rows (dictionaries of {field: value})
+    fields = list(columns.keys())
+    values = [from_column(columns[field]) for field in fields]
+    return [dict(zip(fields, row)) for row in zip(*values)]
+
+def get_cache_key(filepath, fields, cache_dir, data_dictionary = None):
+    key = {
+        "source": fingerprint_file(filepath, cache_dir),
+        "fields": fields,
+        "dictionary": hashlib.sha1(json.dumps(data_dictionary, sort_keys=True).encode()).hexdigest()
+    }
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+def fingerprint_file(filepath, cache_dir):
+    # SHA1 hash of the file contents. Hashing a large file takes a while, so remember the hash 
+    # for each file (in cache_dir/fingerprints.json) and only recompute it if the file's size or mtime change.
+    filepath_fingerprints = os.path.join(cache_dir, "fingerprints.json")
+    fingerprints = {}
+    if os.path.exists(filepath_fingerprints):
+        with open(filepath_fingerprints, "r") as f:
+            fingerprints = json.loads(f.read())
+    source = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    entry = fingerprints.get(source)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["sha1"]
+
+    log("Computing fingerprint of: " + filepath + "..")
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if len(block) == 0:
+                break
+            sha1.update(block)
+    fingerprints[source] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(filepath_fingerprints, "w") as f:
+        f.write(json.dumps(fingerprints, indent=2))
+    return fingerprints[source]["sha1"]
+
+def remove_stale_cache_entries(cache_dir, manifest):
+    # Delete cache entries for the same source file and fields as the new entry: 
+    # they were built from an older version of the file or data dictionary.
+    for entry in os.listdir(cache_dir):
+        filepath_manifest = os.path.join(cache_dir, entry, "manifest.json")
+        if entry.endswith(".tmp") or not os.path.exists(filepath_manifest):
+            continue
+        with open(filepath_manifest, "r") as f:
+            old_manifest = json.loads(f.read())
+        if (old_manifest["source"] == manifest["source"] and old_manifest["requested_fields"] == manifest["requested_fields"]):
+            log("Removing stale cache entry: " + entry)
+            shutil.rmtree(os.path.join(cache_dir, entry))
+
+### Field types
+
+FIELD_CONVERTERS = {
+    "int": int,
+    "float": float
+}
+
+def get_field_type(data_dictionary_compact, field):
+    # Returns the type of a field according to the (compact) data dictionary: 
+    # "int", "float", "categorical" or "string" (the default, also for fields missing from the dictionary).
+    if data_dictionary_compact is None or field not in data_dictionary_compact:
+        return "string"
+    ftype = data_dictionary_compact[field]
+    if isinstance(ftype, dict):
+        return "categorical"
+    return ftype
+
+def get_field_converters(data_dictionary_compact, fields):
+    # Returns a list of (field, function to convert it) for the numeric fields among `fields`
+    converters = []
+    for field in fields:
+        ftype = get_field_type(data_dictionary_compact, field)
+        if ftype in FIELD_CONVERTERS:
+            converters.append((field, FIELD_CONVERTERS[ftype]))
+    return converters
+
+def set_field_types(data_dictionary_compact, field_types):
+    # Mark fields in the (compact) data dictionary as numeric, e.g. set_field_types(dictionary, {"AGE": "int"}).
+    # NOTE: This replaces the valid entries of categorical fields, since numeric fields don't get decoded.
+    for field in field_types:
+        data_dictionary_compact[field] = field_types[field]
+    return data_dictionary_compact
+
+### Categorical encoding
+
+class CategoricalEncoding:
+    # Compact storage for categorical fields: instead of storing the code as a string in every record
+    # (e.g. "1" for SEX, "101" for RELATE), store the position of the code in a decode table built from 
+    # the compact data dictionary. The decode tables are shared across the whole dataset.
+    #   - For columns (see load_csv_columns), each categorical column becomes a uint8/uint16 array, so filters
+    #       like p["WHYNWLY"] == "1" turn into a single integer comparison over the array.
+    #   - For rows (lists of dictionaries), codes become small ints, which Python shares between all records
+    #       rather than allocating a new string for every value.
+    # Codes found in the data but missing from the data dictionary are added to the decode tables 
+    # (with no description) while encoding, so encoding never loses information. Looking up a code 
+    # with index_of never changes the decode tables: unknown codes raise a KeyError.
+
+    ### Example use:
+    # encoding = CategoricalEncoding(data_dictionary_compact)
+    # columns = encoding.encode_columns(load_csv_columns(filepath_data, fields, cache_dir, data_dictionary_compact))
+    # unemployed = columns["WHYNWLY"] == encoding.index_of("WHYNWLY", "1")
+    # encoding.describe("SEX", columns["SEX"][0]) # -> "Male"
+
+    def __init__(self, data_dictionary_compact, fields = "All"):
+        if fields == "All":
+            fields = list(data_dictionary_compact.keys())
+        self.codes = {}         # field -> [code] (the decode table)
+        self.descriptions = {}  # field -> [description]
+        self.index = {}         # field -> {code: position in the decode table}
+        for field in fields:
+            if get_field_type(data_dictionary_compact, field) == "categorical":
+                valid_entries = data_dictionary_compact[field]
+                self.codes[field] = [str(code) for code in valid_entries.keys()]
+                self.descriptions[field] = list(valid_entries.values())
+                self.index[field] = {code: i for (i, code) in enumerate(self.codes[field])}
+
+    def is_categorical(self, field):
+        return field in self.codes
+
+    def index_of(self, field, code):
+        if code not in self.index[field]:
+            raise KeyError("Code " + repr(code) + " not found in the decode table for " + field)
+        return self.index[field][code]
+
+    def _add_code(self, field, code):
+        # Position of code in the decode table, adding it first if it's not in the data dictionary (only used while encoding)
+        if code not in self.index[field]:
+            self.index[field][code] = len(self.codes[field])
+            self.codes[field].append(code)
+            self.descriptions[field].append(None)
+        return self.index[field][code]
+
+    def encode(self, field, values):
+        # Encode a column (numpy array or list of codes) into an array of positions in the decode table
+        values = np.asarray(values)
+        unique_values, inverse = np.unique(values, return_inverse=True) # Only look up each distinct code once
+        if unique_values.dtype.kind == "S":
+            unique_values = [value.decode() for value in unique_values.tolist()]
+        else:
+            unique_values = [str(value) for value in unique_values.tolist()]
+        positions = np.array([self._add_code(field, value) for value in unique_values], dtype=np.int64)
+        return positions[inverse.reshape(-1)].astype(self.get_dtype(field))
+
+    def decode(self, field, positions):
+        # Inverse of encode: positions in the decode table -> codes
+        codes = self.codes[field]
+        return [codes[i] for i in np.asarray(positions).tolist()]
+
+    def describe(self, field, position):
+        return self.descriptions[field][position]
+
+    def get_dtype(self, field):
+        # Smallest unsigned integer type that can hold every position in the decode table
+        return np.uint8 if len(self.codes[field]) <= 2**8 else np.uint16 if len(self.codes[field]) <= 2**16 else np.uint32
+
+    def encode_columns(self, columns):
+        # Returns a new {field: column} dictionary, with the categorical columns encoded (other columns are left as is)
+        return {field: self.encode(field, column) if self.is_categorical(field) else column 
+            for (field, column) in columns.items()}
+
+    def encode_rows(self, data):
+        # Encode the categorical fields of a list of records in place, replacing codes by their positions (ints)
+        fields = [field for field in data[0] if self.is_categorical(field)] if len(data) > 0 else []
+        for field in fields:
+            index = self.index[field]
+            for row in data:
+                code = row[field]
+                row[field] = index[code] if code in index else self._add_code(field, code)
+        return data
+
+    def decode_rows(self, data):
+        # Inverse of encode_rows
+        fields = [field for field in data[0] if self.is_categorical(field)] if len(data) > 0 else []
+        for field in fields:
+            codes = self.codes[field]
+            for row in data:
+                row[field] = codes[row[field]]
+        return data
+
 def save_data_to_csv(data, filepath, fields = "All"):
     log("Saving data to: "+ filepath + "..")
     if fields == "All":
@@ -399,10 +1849,60 @@ def load_JSON(filepath):
         data = json.loads(f.read())
     return data
 
-def save_JSON(data, filepath):
+def save_JSON(data, filepath, compact=False):
+    # With compact=True, the JSON is written without indentation or extra whitespace.
+    log("Saving: " + filepath + "..")
+    with open(filepath, "w") as f:
+        if isinstance(data, (list, dict)):
+            if compact:
+                f.write(json.dumps(data, separators=(",", ":")))
+            else:
+                f.write(json.dumps(data, indent=2))
+        else: # A generator (or other iterable), e.g. from iterate_timeuse_data: write it out one element at a time
+            write_JSON_array(data, f, compact)
+
+def write_JSON_array(records, f, compact=False):
+    # Write an iterable of records to f as a JSON array, one record at a time. 
+    # The output is identical to f.write(json.dumps(list(records), indent=2)) (or the compact equivalent), 
+    # but only one record needs to be in memory at any point.
+    n = 0
+    for record in records:
+        if compact:
+            f.write("[" if n == 0 else ",")
+            f.write(json.dumps(record, separators=(",", ":")))
+        else:
+            f.write("[\n  " if n == 0 else ",\n  ")
+            f.write(json.dumps(record, indent=2).replace("\n", "\n  ")) # Indent the record one level to nest it inside the array
+        n += 1
+    if compact:
+        f.write("[]" if n == 0 else "]")
+    else:
+        f.write("[]" if n == 0 else "\n]")
+
+def load_NDJSON(filepath):
+    # Stream records from a newline-delimited JSON file (one JSON record per line, see save_NDJSON).
+    # This is a generator, so only one record is in memory at a time.
+
+    ### Example use:
+    # for household in load_NDJSON(datadir + "raw/atus16.ndjson"):
+    #     ...
+
+    log("Loading: " + filepath + "..")
+    with open(filepath, "r") as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
+def save_NDJSON(records, filepath, compact=True):
+    # Save an iterable of records (e.g. households or persons) as newline-delimited JSON, one record per line.
+    # Records are written as they come, so memory stays flat even for generators over huge datasets, 
+    # and the file can be read back one record at a time with load_NDJSON.
     log("Saving: " + filepath + "..")
+    separators = (",", ":") if compact else None
     with open(filepath, "w") as f:
-        f.write(json.dumps(data, indent=2))
+        for record in records:
+            f.write(json.dumps(record, separators=separators))
+            f.write("\n")
 
 def parse_dollar_amt(amt_string):
     # Takes a string like "$12,500", strips the "$" and ",", and converts to int
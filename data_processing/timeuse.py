@@ -7,6 +7,13 @@ RECTYPES = {
     "4": "who",
     "5": "eldercare"
 }
+# Level of each record type in the household -> person -> activity -> who hierarchy
+RECTYPE_LEVELS = {
+    "household": 0,
+    "person": 1,
+    "activity": 2,
+    "who": 3
+}
 
 data_dictionary_compact = {} # Gets read in at the same time as the data in the load_timeuse_data_json function
 def get_description(field, code):
@@ -14,7 +21,8 @@ def get_description(field, code):
 
 ### Load
 
-def convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json):
+def convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json, nworkers=1, ndjson=False, 
+    typed=False, fields=None, filters=None):
     ## Convert timeuse data from the IPUMS fixed-width format to JSON
 
     ### Example use:
@@ -23,6 +31,22 @@ def convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepat
     # filepath_dictionary = datadir + "dictionaries/atus16_dictionary_detailed.json"
     # filepath_data_json = datadir + "raw/atus16.json"
     # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json)
+    # Or, to parse the raw data in parallel, e.g. using 32 worker processes:
+    # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json, nworkers=32)
+    # Or, to save newline-delimited JSON (one household per line) which can be streamed back with load_NDJSON:
+    # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, datadir + "raw/atus16.ndjson", ndjson=True)
+    # (with nworkers > 1, this is the fast path: the workers write out the households themselves)
+    # Or, to only convert some of the fields (e.g. skipping the 160 replicate weights):
+    # fields = {
+    #     "household": ["CASEID", "HH_SIZE", "FAMINCOME"],
+    #     "person": ["CASEID", "DAY", "AGE", "SEX", "RACE", "MARST", "RELATE", "EDUC", "EMPSTAT", "FULLPART", "OCC", "WT06"],
+    #     "activity": ["CASEID", "ACTIVITY", "START", "STOP", "DURATION", "WHERE"]
+    # }
+    # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json, fields=fields)
+    # Or, to only convert some of the records (see iterate_timeuse_data), e.g. households in Alaska:
+    # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json, filters={"household": {"STATEFIP": "02"}})
+    # Or, to save the numeric fields (as marked in the data dictionary, see convert_data_dictionary_to_json) as numbers:
+    # convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepath_data_json, typed=True)
 
     # The time use data is hierarchical:
     #   Household
@@ -74,54 +98,134 @@ def convert_timeuse_data_to_json(filepath_data_raw, filepath_dictionary, filepat
 
     data_dictionary_detailed = load_JSON(filepath_dictionary)
 
+    # Households are parsed and written out one at a time, so we never hold the entire dataset in memory
+    if ndjson and nworkers > 1 and get_compression(filepath_data_raw) is None:
+        # The workers write the households out themselves (see parse_fixedwidth_datafile_to_NDJSON)
+        parse_fixedwidth_datafile_to_NDJSON(filepath_data_raw, data_dictionary_detailed, RECTYPES, filepath_data_json, 
+            nest_records=nest_timeuse_records, nworkers=nworkers, typed=typed, fields=fields, filters=filters)
+        log("Data load and conversion complete.")
+        return
+    households = iterate_timeuse_data(filepath_data_raw, data_dictionary_detailed, nworkers, typed, fields, filters)
+    if ndjson:
+        save_NDJSON(households, filepath_data_json)
+    else:
+        save_JSON(households, filepath_data_json)
+    log("Data load and conversion complete.")
+
+def iterate_timeuse_data(filepath_data_raw, data_dictionary_detailed, nworkers=1, typed=False, fields=None, filters=None):
+    # Stream timeuse data from the IPUMS fixed-width format, yielding one complete household 
+    # (with its persons, activities and who records nested inside) at a time.
+    # Memory is bounded by the largest household rather than the size of the file.
+    # With nworkers > 1, the file is parsed in parallel (see parse_fixedwidth_datafile_parallel);
+    # households are still yielded in file order, and memory is bounded by the chunks in flight (2 per worker). 
+    # Every household then gets sent back from the workers though, which usually makes this slower than 
+    # parsing serially: to save the data, use convert_timeuse_data_to_json(.., ndjson=True), which writes it out in the workers.
+    # The raw data file may be compressed (gzip, bzip2 or xz, see open_data_file); 
+    # compressed files are always parsed serially since they can't be split by byte offset.
+    # With typed=True, the fields the data dictionary marks as "int" or "float" (e.g. the weights) are converted 
+    # while decoding (see FixedWidthDecoder), so preprocessing doesn't need to convert them afterwards.
+    # fields optionally restricts which fields get decoded for each record type (see FixedWidthDecoder).
+    # filters optionally gives a filter spec for each record type (see FixedWidthDecoder), e.g. 
+    # {"person": {"AGE": lambda age: int(age) >= 65}}. Records which don't pass the filters are dropped 
+    # together with everything nested under them (e.g. a rejected household's persons and activities),
+    # without ever being decoded.
+
+    ### Example use:
+    # data_dictionary_detailed = load_JSON(datadir + "dictionaries/atus16_dictionary_detailed.json")
+    # for household in iterate_timeuse_data(datadir + "raw/atus16.dat", data_dictionary_detailed):
+    #     ...
+
     log("Loading the raw data from.. ")
     log(filepath_data_raw)
-    data = []
-    with open(filepath_data_raw, "r") as f:
-        line_nr = 0
-        while True:
-            line = f.readline().strip() # Read the next line
-            if len(line) == 0: # If reached EOF, stop
-                break
-
-            # Identify what type of record it is (household, person, activity, who, etc):
-            rectype = RECTYPES[line[0]]
-
-            if rectype == "household":
-                household = parse_fixedwidth_datafile_line(line, data_dictionary_detailed, RECTYPES) # Parse the household information
-                data.append(household) # Append the household to the data
-                household["persons"] = [] # Prepare to parse the persons in the household
-
-            elif rectype == "person":
-                person = parse_fixedwidth_datafile_line(line, data_dictionary_detailed, RECTYPES) # Parse the person information
-                household["persons"].append(person) # Append the person to its household
-                person["activities"] = [] # Prepare to parse the person's activities
-
-            elif rectype == "activity":
-                activity = parse_fixedwidth_datafile_line(line, data_dictionary_detailed, RECTYPES) # Parse the activity information
-                person["activities"].append(activity) # Append the activity to its person
-                activity["who"] = [] # Prepare to parse who else was with the person during the activity
-            
-            elif rectype == "who":
-                who = parse_fixedwidth_datafile_line(line, data_dictionary_detailed, RECTYPES) # Parse who else was with the person during the activity
-                activity["who"].append(who) # Append it to the activity
-            
-            elif rectype == "eldercare":
-                continue # Ignoring this for now
-
-            line_nr += 1    
-            if(line_nr % 10000 == 0):
-                print("# records read: " + str(line_nr))
+    if nworkers > 1 and get_compression(filepath_data_raw) is not None:
+        log("The raw data file is compressed, parsing it serially..")
+        nworkers = 1
+    if nworkers > 1:
+        yield from parse_fixedwidth_datafile_parallel(filepath_data_raw, data_dictionary_detailed, RECTYPES, 
+            nest_records=nest_timeuse_records, nworkers=nworkers, typed=typed, fields=fields, filters=filters)
+        return
+    decoder = FixedWidthDecoder(data_dictionary_detailed, RECTYPES, typed=typed, fields=fields, filters=filters)
+    with open_data_file(filepath_data_raw) as f:
+        yield from nest_timeuse_records(read_fixedwidth_lines(f), decoder)
+
+def nest_timeuse_records(lines, decoder):
+    # Takes an iterable of raw fixed-width lines and assembles them into the
+    # household -> person -> activity -> who hierarchy (see convert_timeuse_data_to_json).
+    # A household is complete as soon as we reach the next household record (or the end of the lines),
+    # so that's when we yield it.
+    # Records rejected by the decoder's filters are skipped, along with all the records nested under them.
+    household = None
+    skip_level = None # While skipping a rejected record, the level of that record in the hierarchy
+    line_nr = 0
+    for line in lines:
+        # Identify what type of record it is (household, person, activity, who, etc):
+        rectype = RECTYPES[line[0]]
+
+        if rectype == "household" and household is not None: # The previous household is complete
+            yield household
+            household = None
+
+        if rectype in RECTYPE_LEVELS:
+            level = RECTYPE_LEVELS[rectype]
+            if skip_level is not None and level > skip_level: # Nested under a rejected record
+                continue
+            skip_level = None
+            if not decoder.accepts(line):
+                skip_level = level
+                continue
+
+        if rectype == "household":
+            household = decoder.decode(line) # Parse the household information
+            household["persons"] = [] # Prepare to parse the persons in the household
+
+        elif rectype == "person":
+            person = decoder.decode(line) # Parse the person information
+            household["persons"].append(person) # Append the person to its household
+            person["activities"] = [] # Prepare to parse the person's activities
+
+        elif rectype == "activity":
+            activity = decoder.decode(line) # Parse the activity information
+            person["activities"].append(activity) # Append the activity to its person
+            activity["who"] = [] # Prepare to parse who else was with the person during the activity
+        
+        elif rectype == "who":
+            who = decoder.decode(line) # Parse who else was with the person during the activity
+            activity["who"].append(who) # Append it to the activity
+        
+        elif rectype == "eldercare":
+            continue # Ignoring this for now
+
+        line_nr += 1    
+        if(line_nr % 10000 == 0):
+            log("# records read: " + str(line_nr))
+
+    if household is not None: # The last household
+        yield household
+
+def open_timeuse_household_index(filepath_data_raw, data_dictionary_detailed, typed=False, fields=None):
+    # Random access to individual households in the raw data file, by CASEID, without loading the entire file.
 
-    log("Data load and conversion complete.")
-    save_JSON(data, filepath_data_json)
+    ### Example use:
+    # index = open_timeuse_household_index(datadir + "raw/atus16.dat", data_dictionary_detailed)
+    # print_household_profile(index.get("20160101160045"))
+
+    return HouseholdIndex(filepath_data_raw, data_dictionary_detailed, RECTYPES, "CASEID", nest_timeuse_records, typed=typed, fields=fields)
 
 def load_timeuse_data_json(filepath_data, filepath_dictionary):
-    global data_dictionary_compact
-    data_dictionary_compact = load_JSON(filepath_dictionary)
+    load_timeuse_dictionary(filepath_dictionary)
     data = load_JSON(filepath_data)    
     return data
 
+def iterate_timeuse_data_ndjson(filepath_data, filepath_dictionary):
+    # Streaming version of load_timeuse_data_json, for data saved with convert_timeuse_data_to_json(.., ndjson=True)
+    load_timeuse_dictionary(filepath_dictionary)
+    return load_NDJSON(filepath_data)
+
+def load_timeuse_dictionary(filepath_dictionary):
+    global data_dictionary_compact
+    data_dictionary_compact = load_JSON(filepath_dictionary)
+    return data_dictionary_compact
+
 ### Pre-process
 
 def preprocess_timeuse_data(data, filepath_dictionary, filepath_activity_map, flatten="none"):
@@ -136,17 +240,59 @@ def preprocess_timeuse_data(data, filepath_dictionary, filepath_activity_map, fl
         data = flatten_timeuse_data(data)
     return data
 
+def iterate_preprocessed_timeuse_data(households, filepath_dictionary, filepath_activity_map, flatten="none"):
+    # Streaming version of preprocess_timeuse_data: takes an iterable of households 
+    # (e.g. from iterate_timeuse_data) and yields them preprocessed, one at a time.
+    # NOTE: Expects the compact data dictionary to have been loaded (see load_timeuse_dictionary).
+
+    ### Example use:
+    # load_timeuse_dictionary(filepath_dictionary_compact)
+    # households = iterate_timeuse_data(filepath_data_raw, load_JSON(filepath_dictionary_detailed))
+    # households = iterate_preprocessed_timeuse_data(households, filepath_dictionary_compact, filepath_activity_map, flatten="full")
+    # save_JSON(households, filepath_data_json)
+
+    log("Preprocessing timeuse data.. ")
+    mapping = load_activity_map(filepath_activity_map, filepath_dictionary)
+    weight_fields = None
+    for hh in households:
+        if weight_fields is None:
+            weight_fields = get_weight_fields(hh)
+        if len(weight_fields) > 0:
+            convert_household_weights_to_float(hh, weight_fields)
+        hh.update(get_poverty_info(hh))
+        remap_household_activity_field(hh, mapping)
+        p = hh["persons"][0]
+        p["aggregate_activity_times"] = get_aggregate_activity_times(p, "ACTIVITY2")
+        if(flatten == "partial"):
+            hh = partially_flatten_household(hh)
+        elif(flatten == "full"):
+            hh = flatten_household(hh)
+        yield hh
+
 def convert_weights_to_float(data):
+    weight_fields = get_weight_fields(data[0])
+    if len(weight_fields) == 0:
+        return data # Already converted while decoding
     log("Converting weights to float..")
+    for hh in data:
+        convert_household_weights_to_float(hh, weight_fields)
+    return data
+
+def get_weight_fields(household):
+    # Weight fields which still need to be converted to float: 
+    # none if the data was decoded with typed=True (see iterate_timeuse_data)
+    if isinstance(household["persons"][0]["WT06"], float):
+        return []
     weight_fields = ["WT06"]
     # If replicate weights are included in the dataset, prepare to convert them as well
-    if("RWT06_1" in data[0]["persons"][0]): 
+    if("RWT06_1" in household["persons"][0]): 
         weight_fields = weight_fields + list(map(lambda i: "RWT06_"+str(i+1), range(160)))
-    for hh in data:
-        for p in hh["persons"]:
-            for weight_field in weight_fields:
-                p[weight_field] = float(p[weight_field])
-    return data
+    return weight_fields
+
+def convert_household_weights_to_float(household, weight_fields):
+    for p in household["persons"]:
+        for weight_field in weight_fields:
+            p[weight_field] = float(p[weight_field])
 
 def get_poverty_info(household):
     # Official poverty guidelines for 2016
@@ -202,6 +348,15 @@ def annotate_data_with_poverty_info(data):
 
 def remap_activity_field(data, filepath_map, filepath_dictionary):
     log("Remapping the activity field.. ")
+    mapping = load_activity_map(filepath_map, filepath_dictionary)
+
+    # Remap the data
+    for hh in data: 
+        remap_household_activity_field(hh, mapping)
+
+    return data
+
+def load_activity_map(filepath_map, filepath_dictionary):
     with open(filepath_map, "r") as f:
         # Read the mapping from the file
         r = csv.DictReader(f)
@@ -215,17 +370,16 @@ def remap_activity_field(data, filepath_map, filepath_dictionary):
                 "Description": row["Description2"]
             }
 
-    # Remap the data
-    for hh in data: 
-        activities = hh["persons"][0]["activities"]
-        for a in activities:
-            a["ACTIVITY2"] = mapping[a["ACTIVITY"]]["Code"]
-
     # Add the new field to the data_dictionary & re-save the dictionary
     data_dictionary_compact["ACTIVITY2"] = {entry["Code"]: entry["Description"] for entry in mapping.values()}
     save_JSON(data_dictionary_compact, filepath_dictionary)
 
-    return data
+    return mapping
+
+def remap_household_activity_field(household, mapping):
+    activities = household["persons"][0]["activities"]
+    for a in activities:
+        a["ACTIVITY2"] = mapping[a["ACTIVITY"]]["Code"]
 
 def get_aggregate_activity_times(person, activity_field):
     # Initialize all possible activities to zero
@@ -260,30 +414,30 @@ def annotate_data_with_aggregate_activity_times(data, activity_field):
 
 def partially_flatten_timeuse_data(data):
     log("Partially flattening timeuse data.. ")
-    flat_data = []
-    for household in data:
-        flatp = {}        
-        # Add all the household characteristics
-        flatp.update({k:household[k] for k in household.keys() if k!="persons"})
-        # Add person characteristics ONLY for the person being interviewed (person #0)
-        flatp.update(household["persons"][0])
-        flat_data.append(flatp)
-    return flat_data
+    return [partially_flatten_household(household) for household in data]
+
+def partially_flatten_household(household):
+    flatp = {}        
+    # Add all the household characteristics
+    flatp.update({k:household[k] for k in household.keys() if k!="persons"})
+    # Add person characteristics ONLY for the person being interviewed (person #0)
+    flatp.update(household["persons"][0])
+    return flatp
 
 def flatten_timeuse_data(data):
     log("Flattening time use data.. ")
-    flat_data = []
-    for household in data:
-        flatp = {}
-        # Add all the household characteristics
-        flatp.update({k:household[k] for k in household.keys() if k!="persons"})
-        # Add person characteristics ONLY for the person being interviewed (person #0)
-        person = household["persons"][0]
-        flatp.update({k:person[k] for k in person.keys() if k!="activities"})
-        # Add aggregate activity times for that person
-        flatp.update(person["aggregate_activity_times"])
-        flat_data.append(flatp)
-    return flat_data
+    return [flatten_household(household) for household in data]
+
+def flatten_household(household):
+    flatp = {}
+    # Add all the household characteristics
+    flatp.update({k:household[k] for k in household.keys() if k!="persons"})
+    # Add person characteristics ONLY for the person being interviewed (person #0)
+    person = household["persons"][0]
+    flatp.update({k:person[k] for k in person.keys() if k!="activities"})
+    # Add aggregate activity times for that person
+    flatp.update(person["aggregate_activity_times"])
+    return flatp
 
 ### Explore
 
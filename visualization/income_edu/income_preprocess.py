@@ -1,32 +1,73 @@
 import csv
 import json
-from math import ceil
+import math
 import random
 
 DATADIR = "/Users/adona/data/census/cps/"
 
 ### Helper functions
 
-def load_csv_data(filepath, fields = "All"):
-    print("Loading data from: " + filepath + "..")
+def iterate_csv_data(filepath, fields = "All", filters = None):
+    # Streams the rows of a CSV file as dictionaries, one at a time, so the file never needs to fit in memory.
+    # filters optionally maps fields to the list of values to keep, e.g. {"WORKLY": ["2"]}.
+    # Rows get checked before they're built, so rows which are filtered out never take up any memory.
+    print("Streaming data from: " + filepath + "..")
     print("Loading fields: " + str(fields))
             
     with open(filepath, "r") as f:
-        r = csv.DictReader(f)
-        data = []
+        r = csv.reader(f)
+        header = next(r)
+        if fields == "All":
+            fields = header
+        idx = [header.index(field) for field in fields]
+        checks = [(header.index(field), set(values)) for (field, values) in (filters or {}).items()]
         nrows = 0
+        nkept = 0
         for row in r:
-            if(fields == 'All'):
-                data.append(row)
-            else:
-                data.append({field: row[field] for field in fields})
+            if len(row) == 0: # Skip blank lines
+                continue
             nrows += 1
             if (nrows % 10000 == 0):
                 print("Record #: " + str(nrows))
-        print("Finished loading file: " + filepath)
-        print("# of records: " + str(len(data)))
-    
-    return data
+            if all(row[i] in values for (i, values) in checks):
+                nkept += 1
+                yield {field: row[i] for (field, i) in zip(fields, idx)}
+        print("Finished reading file: " + filepath)
+        print("# of records kept: " + str(nkept) + " (out of " + str(nrows) + ")")
+
+def weighted_sample(rows, weight_field, k, randseed = None):
+    # Weighted random sample of k rows, WITH replacement, in a single pass over a stream of rows: each of the 
+    # k draws picks row i with probability w_i / W (W = total weight), so the sample has the same distribution 
+    # as expanding every row by its weight and subsampling. 
+    # Each draw is a "slot" holding a weighted reservoir of size 1: with a running total W, the row just read 
+    # replaces the contents of each slot independently with probability w / W. The slots it replaces are found 
+    # by jumping from one to the next with geometrically distributed gaps, so each row only costs as many steps
+    # as slots it replaces (k * w / W on average), rather than k.
+    # Only the k slots are ever held in memory. Rows with weight <= 0 are never sampled. 
+    # Rows are returned in the order they were read (rows drawn more than once appear multiple times).
+    print("Sampling " + str(k) + " rows (weighted by " + weight_field + ")..")
+    rng = random.Random(randseed)
+    slots = [None] * k # (row #, row)
+    total_weight = 0
+    for (nrow, row) in enumerate(rows):
+        weight = float(row[weight_field])
+        if weight <= 0:
+            continue
+        total_weight += weight
+        p = weight / total_weight
+        if p >= 1: # First row: fills every slot
+            slots = [(nrow, row)] * k
+            continue
+        log_q = math.log1p(-p)
+        i = -1
+        while True:
+            i += 1 + int(math.log1p(-rng.random()) / log_q) # Skip the slots which are not replaced
+            if i >= k:
+                break
+            slots[i] = (nrow, row)
+    if total_weight == 0:
+        return []
+    return [row for (nrow, row) in sorted(slots, key=lambda slot: slot[0])]
 
 def save_data_to_csv(data, filepath, fields = "All"):
     print("Saving data to: "+ filepath + "..")
@@ -62,28 +103,7 @@ def save_JSON(data, filepath):
         f.write(json.dumps(data, indent=2))
 
 
-### Load the data
-print("Loading data..")
-filepath_data = DATADIR + "raw/asec16.csv"
-# Variables on education, work, and income
-fields = ["WORKLY", "CLASSWLY", "FULLPART", "WKSWORK2", "INCWAGE", "OCCLY", "EDUC", "ASECWT"]
-data = load_csv_data(filepath_data, fields=fields) # 185,487
-
-
-### Filter the data: 
-print("Filtering data..")
-# Only keep people who..
-# .. worked last year
-data = [p for p in data if p["WORKLY"] == "2"] # 92,157
-# .. for wages (not self-employed)
-data = [p for p in data if p["CLASSWLY"] in ["22", "25", "27", "28"]] # 83,432
-# .. full time (at least 35h/week)
-data = [p for p in data if p["FULLPART"] == "1"] # 67,155
-# .. the entire year (at least 50 weeks)
-data = [p for p in data if p["WKSWORK2"] == "6"] # 57,443
-
-
-### Annotate data with occupation categories
+### Set up the occupation categories
 # Load the occupation dictionary
 # The dictionary is structured hierarchically by category: 
 # {
@@ -92,7 +112,7 @@ data = [p for p in data if p["WKSWORK2"] == "6"] # 57,443
 #         "20" : "General and operations managers",
 #         "30" : "Legislators",
 # ... 
-print("Annotating data with occupation categories..")
+print("Setting up occupation categories..")
 filepath_occupations_dictionary = DATADIR + "dictionaries/occ_hierarchical.json"
 occupations_dictionary = load_JSON(filepath_occupations_dictionary)
 
@@ -111,13 +131,9 @@ for (idx, category_description) in enumerate(occupations_dictionary.keys()):
     occupations[occupation_code] = occupation_description
     occupation_to_category_map[occupation_code] = category_code
 
-# Annotate dataset with occupation categories
-for p in data:
-  p["CATLY"] = occupation_to_category_map[p["OCCLY"]]
 
-
-### Remap the education field to lower granularity codes
-print("Remapping the education field to lower granularity codes..")
+### Set up the lower granularity education codes
+print("Setting up lower granularity education codes..")
 # Define new education levels
 educ_new_descriptions = ["None", "Some Primary / Secondary", "Some Highschool", 
               "Highschool Diploma", "Some College", "Associate's Degree", 
@@ -139,38 +155,39 @@ for (idx, code_group) in enumerate(educ_old_code_groups):
   new_code = str(idx)
   for old_code in code_group:
     educ_map[old_code] = new_code
-# Remap the data
-for p in data:
-  p["EDUC2"] = educ_map[p["EDUC"]]
 education_levels = {str(idx):description for (idx, description) in enumerate(educ_new_descriptions)}
 
 
-### Save data and dictionary
-print("Saving the data and data dictionary..")
+### Stream the data through a single pipeline: read + filter -> annotate -> subsample
+# Only the subsample is ever held in memory, so this also works on (much) larger, e.g. multi-year pooled, extracts.
+filepath_data = DATADIR + "raw/asec16.csv"
+# Variables on education, work, and income
+fields = ["WORKLY", "CLASSWLY", "FULLPART", "WKSWORK2", "INCWAGE", "OCCLY", "EDUC", "ASECWT"]
+# Only keep people who..
+filters = {
+  "WORKLY": ["2"], # .. worked last year (92,157)
+  "CLASSWLY": ["22", "25", "27", "28"], # .. for wages (not self-employed) (83,432)
+  "FULLPART": ["1"], # .. full time (at least 35h/week) (67,155)
+  "WKSWORK2": ["6"] # .. the entire year (at least 50 weeks) (57,443)
+}
+data = iterate_csv_data(filepath_data, fields=fields, filters=filters) # 57,443 (out of 185,487)
 
-# Subsample the dataset (according to the weights ASECWT):
-# 1. Normalize the weights to integers in [1,100]
-for p in data:
-  p["ASECWT"] = float(p["ASECWT"])   # Convert weights to float
-max_w = max([p["ASECWT"] for p in data])
-max_w_norm = 100
-for p in data:
-  p["ASECWT_norm"] = ceil(p["ASECWT"] / max_w * max_w_norm)  # Normalize
-
-# 2. Construct an unweighted "expanded dataset" containing 
-# norm_weight number of copies of each datapoint
-# and subsample it on the fly
-n_expanded = sum([p["ASECWT_norm"] for p in data])
+def annotate(data):
+  for p in data:
+    p["CATLY"] = occupation_to_category_map[p["OCCLY"]] # Occupation category
+    p["EDUC2"] = educ_map[p["EDUC"]] # Lower granularity education code
+    yield p
+
+# Subsample the dataset according to the weights ASECWT, i.e. draw a sample in which each person 
+# is drawn with probability proportional to the number of people they represent (with replacement, 
+# like expanding each person by their weight and subsampling)
 n_target = 10000
-subsampling_factor = n_target / n_expanded
-subsampled_data = []
 randseed = 109787
-random.seed(randseed)
-for p in data:
-  norm_weight = p["ASECWT_norm"]
-  for i in range(norm_weight): # for each copy
-      if (random.random() < subsampling_factor): # subsample
-          subsampled_data.append(p)
+subsampled_data = weighted_sample(annotate(data), "ASECWT", n_target, randseed)
+
+
+### Save data and dictionary
+print("Saving the data and data dictionary..")
 
 # Save the subsampled dataset
 fields = ["EDUC2", "INCWAGE", "OCCLY", "CATLY"]